@@ -1,29 +1,187 @@
 #!/usr/bin/env python
 
 from __future__ import unicode_literals
+import array
+import atexit
+import bisect
+import collections
 import datetime
+import errno
+import gzip
+import heapq
 import json
 import math
+import mmap
+import os
 from pprint import pformat
+import queue
 import random
 import sys
 import select
+import socket
+import struct
+import threading
 import time
 import traceback
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 # Utilities
 
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warn": WARN, "error": ERROR}
+
+
+class Pretty:
+    """Wraps an object so it's only pretty-printed if a log line is written."""
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return pformat(self.obj, width=128)
+
+
+class Logger:
+    """Leveled logging to stderr. Lines below the current level are dropped
+    before any formatting happens. The rest are rendered on the caller's
+    thread (the objects they mention may change later), pushed onto a bounded
+    ring buffer, and written out in batches by a background thread."""
+
+    def __init__(self, out, level=INFO, capacity=100000, interval=0.01):
+        self.out = out              # Where lines are written
+        self.level = level          # Drop lines below this level
+        self.lines = collections.deque(maxlen=capacity)  # Pending (time, line)s
+        self.interval = interval    # Seconds to gather a batch before writing
+        self.dropped = 0            # Lines lost to a full buffer
+        self.pending = threading.Event()  # Set when lines are waiting
+        self.lock = threading.Lock()      # Held while writing a batch
+        self.thread = None
+
+    def write(self, level, args):
+        """Buffers a line joining args with spaces, if level is enabled."""
+        if level < self.level:
+            return
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append((time.time(), " ".join(str(a) for a in args)))
+        if not self.pending.is_set():
+            self.pending.set()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="logger")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def flush(self):
+        """Writes everything buffered so far."""
+        with self.lock:
+            batch = []
+            while self.lines:
+                t, line = self.lines.popleft()
+                batch.append(datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M:%S.%f "))
+                batch.append(line)
+                batch.append("\n")
+            if self.dropped:
+                batch.append("(dropped " + str(self.dropped) + " log lines)\n")
+                self.dropped = 0
+            if batch:
+                self.out.write("".join(batch))
+                self.out.flush()
+
+    def run(self):
+        """Writer thread: waits for lines, lets a batch build up, writes it."""
+        while True:
+            self.pending.wait()
+            time.sleep(self.interval)
+            self.pending.clear()
+            self.flush()
+
+
+logger = Logger(sys.stderr, LEVELS[os.environ.get("RAFT_LOG_LEVEL", "info")])
+atexit.register(logger.flush)
+
 
 def log(*args):
     """Helper function for logging stuff to stderr"""
-    first = True
-    sys.stderr.write(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f "))
-    for i in range(len(args)):
-        sys.stderr.write(str(args[i]))
-        if i < (len(args) - 1):
-            sys.stderr.write(" ")
-    sys.stderr.write("\n")
-    sys.stderr.flush()
+    logger.write(INFO, args)
+
+
+def debug(*args):
+    """Logs at debug level; cheap to call when debug logging is off."""
+    logger.write(DEBUG, args)
+
+
+def error(*args):
+    """Logs at error level."""
+    logger.write(ERROR, args)
+
+
+class Codec:
+    """Encodes messages as compact JSON bytes, and decodes them, using orjson
+    or ujson if they're installed and the standard library otherwise."""
+
+    def __init__(self, name=None):
+        if not name:
+            name = "orjson" if orjson else "ujson" if ujson else "json"
+        self.name = name
+        if name == "orjson":
+            self.dumps = self.orjson_dumps
+            self.loads = orjson.loads
+        elif name == "ujson":
+            self.dumps = self.ujson_dumps
+            self.loads = ujson.loads
+        elif name == "json":
+            self.encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+            self.dumps = self.json_dumps
+            self.loads = json.loads
+        else:
+            raise RuntimeError("unknown JSON codec " + name)
+
+    def orjson_dumps(self, obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def ujson_dumps(self, obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+    def json_dumps(self, obj):
+        return self.encoder.encode(obj).encode("utf-8")
+
+
+codec = Codec(os.environ.get("RAFT_JSON"))
+
+
+def write_durably(path, data):
+    """Atomically replaces the file at path with data (bytes), and makes sure
+    it's on disk before returning."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+    fsync_dir(os.path.dirname(path))
+
+
+def fsync_dir(path):
+    """Flushes a directory's entries (file creations, renames, removals) to disk."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def majority(n):
@@ -38,19 +196,770 @@ def median(xs):
     return xs[len(xs) - majority(len(xs))]
 
 
-class Net:
-    """Handles console IO for sending and receiving messages."""
+class QuorumTracker:
+    """Tracks a value per node, like match indices, along with the highest
+    value a majority of nodes have reached. Changing one node's value costs a
+    binary search, rather than re-sorting everything."""
+
+    def __init__(self, values):
+        self.values = dict(values)          # Map of nodes to values
+        self.sorted = sorted(self.values.values())
+
+    def update(self, node, value):
+        """Sets node's value. Returns True if it changed."""
+        old = self.values[node]
+        if old == value:
+            return False
+        del self.sorted[bisect.bisect_left(self.sorted, old)]
+        bisect.insort(self.sorted, value)
+        self.values[node] = value
+        return True
+
+    def quorum_value(self):
+        """The highest value a majority of nodes have reached; like median."""
+        return self.sorted[len(self.sorted) - majority(len(self.sorted))]
+
+
+class Timers:
+    """A heap of named deadlines, so the mainloop knows how long it can sleep.
+    Setting a timer again supersedes its earlier deadline; stale heap entries
+    are discarded lazily."""
+
+    def __init__(self):
+        self.heap = []          # A heap of [deadline, name] pairs
+        self.deadlines = {}     # A map of timer names to their live deadlines
+
+    def set(self, name, deadline):
+        """Arrange for the named timer to go off at deadline, in epoch seconds."""
+        if self.deadlines.get(name) == deadline:
+            return
+        self.deadlines[name] = deadline
+        heapq.heappush(self.heap, (deadline, name))
+        if 64 < len(self.heap) and 4 * len(self.deadlines) < len(self.heap):
+            # Mostly stale entries; rebuild from the live ones.
+            self.heap = [(d, n) for n, d in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def cancel(self, name):
+        """Forget about the named timer."""
+        self.deadlines.pop(name, None)
+
+    def next_deadline(self):
+        """The earliest live deadline, or None if no timers are set."""
+        while self.heap:
+            deadline, name = self.heap[0]
+            if self.deadlines.get(name) == deadline:
+                return deadline
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, now):
+        """Removes every timer whose deadline is at or before now, and returns
+        their names in deadline order."""
+        due = []
+        while True:
+            deadline = self.next_deadline()
+            if deadline is None or now < deadline:
+                return due
+            deadline, name = heapq.heappop(self.heap)
+            del self.deadlines[name]
+            due.append(name)
+
+
+class Histogram:
+    """Latencies in log-linear buckets, HDR-style: each power of two of
+    microseconds is split into 16 linear buckets, so percentiles come out
+    within about 6% whatever the scale, in a few hundred counters at most."""
+
+    SUB = 16    # Linear buckets per power of two
 
     def __init__(self):
+        self.counts = collections.Counter()  # Bucket to count
+        self.count = 0
+        self.total = 0.0        # Sum of recorded values, for the mean
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        """Adds a value, in seconds."""
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or self.max < seconds:
+            self.max = seconds
+        n = max(0, int(seconds * 1e6))
+        if n < 2 * self.SUB:
+            self.counts[n] += 1
+        else:
+            shift = n.bit_length() - 5
+            self.counts[2 * self.SUB + (shift - 1) * self.SUB + (n >> shift) - self.SUB] += 1
+
+    def merge(self, other):
+        """Adds everything recorded in another histogram to this one."""
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.total += other.total
+        for v in (other.min, other.max):
+            if v is not None:
+                self.min = v if self.min is None else min(self.min, v)
+                self.max = v if self.max is None else max(self.max, v)
+
+    def value(self, bucket):
+        """The midpoint of a bucket, in seconds."""
+        if bucket < 2 * self.SUB:
+            return bucket / 1e6
+        shift, top = divmod(bucket - 2 * self.SUB, self.SUB)
+        shift += 1
+        top += self.SUB
+        return ((top << shift) + (1 << (shift - 1))) / 1e6
+
+    def percentile(self, p):
+        """The value p percent of recorded values are at or below."""
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(self.count * p / 100.0)))
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if rank <= seen:
+                return min(self.max, max(self.min, self.value(bucket)))
+
+    def summary(self):
+        """Count, mean, extremes, and percentiles, in seconds."""
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else None,
+            "min": self.min,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+            "max": self.max,
+            }
+
+
+class Profiler:
+    """A sampling profiler: a background thread that, every interval seconds,
+    looks at what one thread is doing and tallies its stack. Unlike cProfile
+    it doesn't hook every call, so the profiled thread runs at nearly full
+    speed and it's fine to turn on in production. Writes collapsed stacks,
+    "outer;...;inner count" a line, which flamegraph.pl and speedscope read."""
+
+    def __init__(self, path, seconds, interval=0.005, thread_id=None):
+        self.path = path        # Where we write the stacks when we're done
+        self.seconds = seconds  # How long to sample for
+        self.interval = interval  # Seconds between samples
+        self.thread_id = thread_id or threading.current_thread().ident
+        self.stacks = collections.Counter()  # Collapsed stacks to samples
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops sampling early, and waits for the stacks to be written."""
+        self.stopped.set()
+        self.thread.join()
+
+    def running(self):
+        return self.thread.is_alive()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (code.co_name,
+                os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        stack.reverse()
+        self.stacks[";".join(stack)] += 1
+        self.samples += 1
+
+    def run(self):
+        deadline = time.time() + self.seconds
+        while not self.stopped.wait(self.interval) and time.time() < deadline:
+            self.sample()
+        try:
+            with open(self.path, "w") as f:
+                for stack, n in self.stacks.most_common():
+                    f.write("%s %d\n" % (stack, n))
+            log("Wrote", self.samples, "profile samples to", self.path)
+        except Exception:
+            error("Couldn't write profile!", traceback.format_exc())
+
+
+profiler = None     # The last Profiler we started, if any
+
+
+def start_profile(body):
+    """Starts profiling this thread, as a profile message's body asks: for
+    "seconds" (default 10), writing collapsed stacks to a file in
+    RAFT_PROFILE_DIR (default: the current directory). Returns the body of
+    our reply."""
+    global profiler
+    if profiler is not None and profiler.running():
+        return {"type": "error", "code": 11, "text": "already profiling"}
+    seconds = min(float(body.get("seconds", 10)), 600)
+    path = os.path.join(os.environ.get("RAFT_PROFILE_DIR", "."),
+                        "raft-profile-%d-%d.txt" % (os.getpid(), int(time.time())))
+    profiler = Profiler(path, seconds).start()
+    return {"type": "profile_ok", "file": os.path.abspath(path), "seconds": seconds}
+
+
+class Recorder:
+    """Writes every message we receive to a trace file, a line each: seconds
+    since we started recording, a space, and the message's JSON. Messages
+    that arrived together share a timestamp, so a replay can hand them over
+    together too. The first line, "#seed N", is what we reseeded random
+    with, so a replay can make the same random choices. Paths ending in .gz
+    are gzipped, which shrinks a trace around tenfold. We flush about once a
+    second, so a killed node loses at most the last second."""
+
+    def __init__(self, path, clock=time.time):
+        if path.endswith(".gz"):
+            self.file = gzip.open(path, "wb", compresslevel=1)
+        else:
+            self.file = open(path, "wb")
+        self.path = path
+        self.clock = clock
+        self.start = clock()
+        self.last_flush = self.start
+        self.msgs = 0
+        seed = random.randrange(1 << 32)
+        random.seed(seed)
+        self.file.write(("#seed %d\n" % seed).encode("utf-8"))
+
+    def record(self, msgs):
+        now = self.clock()
+        t = ("%.6f " % (now - self.start)).encode("utf-8")
+        self.file.write(b"".join(t + codec.dumps(msg) + b"\n" for msg in msgs))
+        self.msgs += len(msgs)
+        if 1 <= now - self.last_flush:
+            self.file.flush()
+            self.last_flush = now
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            log("Recorded", self.msgs, "messages to", self.path)
+
+
+class StdioTransport:
+    """Moves messages over stdin and stdout, one JSON object per line."""
+
+    def __init__(self, codec=codec):
+        self.codec = codec      # How we encode and decode messages
+        self.in_buffer = b""    # Bytes read from stdin, but not yet a full line
+        self.max_read = 1 << 20 # Stop draining stdin after this many bytes
+        self.bytes_in = 0       # Bytes read, all told...
+        self.bytes_out = 0      # ...and written
+
+    def read(self, timeout):
+        """Waits up to timeout seconds (forever, if None) for input on stdin,
+        then returns every complete message that's arrived, decoded, and
+        whether stdin is still open."""
+        fd = sys.stdin.fileno()
+        still_open = True
+        chunks = [self.in_buffer]
+        read = 0
+
+        # Block for the first chunk, then drain whatever else is already
+        # waiting without blocking again.
+        while read < self.max_read and fd in select.select([fd], [], [], timeout)[0]:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                still_open = False
+                break
+            chunks.append(chunk)
+            read += len(chunk)
+            timeout = 0
+        self.bytes_in += read
+
+        lines = b"".join(chunks).split(b"\n")
+        self.in_buffer = lines.pop()
+        msgs = []
+        for line in lines:
+            if line.strip():
+                try:
+                    msgs.append(self.codec.loads(line))
+                except Exception:
+                    error("Error decoding message!", traceback.format_exc())
+        return msgs, still_open
+
+    def write(self, msgs):
+        """Encodes messages and writes them to stdout at once."""
+        data = b"\n".join([self.codec.dumps(m) for m in msgs]) + b"\n"
+        self.bytes_out += len(data)
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    def close(self):
+        """Nothing's left unwritten; nothing to do."""
+        pass
+
+
+class ThreadedStdioTransport(StdioTransport):
+    """Like StdioTransport, but reads and decodes on one thread, and encodes
+    and writes on another. The consensus loop only ever sees parsed messages
+    and never waits on a pipe, so a burst of big appends can't hold up its
+    timers, and decoding and encoding overlap with its work."""
+
+    def __init__(self, codec=codec):
+        StdioTransport.__init__(self, codec)
+        # By default, a busy thread keeps the GIL for 5ms before the others
+        # get a turn, which would add that to every message in or out.
+        sys.setswitchinterval(0.0005)
+        self.inbox = queue.Queue()   # Lists of decoded messages; None at EOF
+        self.outbox = queue.Queue()  # Lists of messages to write; None to stop
+        self.eof = False        # Have we handed out everything before EOF?
+        self.reader = threading.Thread(target=self.run_reader, name="reader")
+        self.reader.daemon = True
+        self.reader.start()
+        self.writer = threading.Thread(target=self.run_writer, name="writer")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def run_reader(self):
+        """Reader thread: decodes input as it arrives."""
+        while True:
+            msgs, still_open = StdioTransport.read(self, None)
+            if msgs:
+                self.inbox.put(msgs)
+            if not still_open:
+                self.inbox.put(None)
+                return
+
+    def read(self, timeout):
+        """Waits up to timeout seconds (forever, if None) for messages from
+        the reader thread, then returns every one it's decoded so far, and
+        whether stdin is still open."""
+        msgs = []
+        if self.eof:
+            return msgs, False
+        try:
+            batch = self.inbox.get(True, timeout)
+            while batch is not None:
+                msgs.extend(batch)
+                batch = self.inbox.get_nowait()
+            self.eof = True
+        except queue.Empty:
+            pass
+        return msgs, not self.eof
+
+    def write(self, msgs):
+        """Queues messages for the writer thread."""
+        self.outbox.put(msgs)
+
+    def run_writer(self):
+        """Writer thread: encodes and writes whatever's queued, in one go."""
+        while True:
+            msgs = self.outbox.get()
+            if msgs is None:
+                return
+            batch = list(msgs)
+            try:
+                while True:
+                    more = self.outbox.get_nowait()
+                    if more is None:
+                        self.outbox.put(None)
+                        break
+                    batch.extend(more)
+            except queue.Empty:
+                pass
+            StdioTransport.write(self, batch)
+
+    def close(self):
+        """Waits for the writer thread to write everything queued."""
+        self.outbox.put(None)
+        self.writer.join()
+
+
+def parse_address(address):
+    """Splits "host:port" into a (host, port) pair."""
+    host, port = address.rsplit(":", 1)
+    return (host, int(port))
+
+
+class TcpConnection:
+    """One TCP connection carrying messages: length-prefixed frames between
+    nodes, or lines of JSON to and from a client."""
+
+    FRAME = struct.Struct("!I")
+    MAX_FRAME = 64 << 20
+
+    def __init__(self, sock, framed, peer=None):
+        self.sock = sock            # None while a peer connection is down
+        self.framed = framed        # Frames, or lines?
+        self.peer = peer            # The node we dialed, if we did
+        self.client_id = None       # What we call a client that doesn't say
+        self.connecting = False     # Waiting on a non-blocking connect?
+        self.in_buffer = bytearray()
+        self.out_buffer = bytearray()
+        self.retry_at = 0           # When we can redial a dropped peer
+        self.backoff = 0            # How long to wait after the next drop
+
+    def queue(self, data):
+        """Buffers an encoded message to send."""
+        if self.framed:
+            self.out_buffer += self.FRAME.pack(len(data))
+            self.out_buffer += data
+        else:
+            self.out_buffer += data
+            self.out_buffer += b"\n"
+
+    def decode(self):
+        """Takes every complete encoded message out of the input buffer."""
+        buf = self.in_buffer
+        msgs = []
+        pos = 0
+        if self.framed:
+            while self.FRAME.size <= len(buf) - pos:
+                n = self.FRAME.unpack_from(buf, pos)[0]
+                if self.MAX_FRAME < n:
+                    raise IOError("frame of " + str(n) + " bytes is too big")
+                if len(buf) - pos - self.FRAME.size < n:
+                    break
+                pos += self.FRAME.size
+                msgs.append(bytes(buf[pos:pos + n]))
+                pos += n
+        else:
+            end = buf.rfind(b"\n") + 1
+            msgs = [l for l in bytes(buf[:end]).split(b"\n") if l.strip()]
+            pos = end
+        del buf[:pos]
+        return msgs
+
+
+class TcpTransport:
+    """Moves messages over TCP rather than stdin and stdout, so nodes can run
+    as a real cluster with no relay in between. Each node dials one
+    persistent connection to every peer, redialing with exponential backoff
+    when it drops, and sends length-prefixed frames over it; whatever a
+    flush sends a peer goes out in a single write. Clients connect to a
+    separate listener and exchange lines of JSON, as Maelstrom would.
+
+    We name each client after the node it's connected to, "tcp-n1-" and then
+    the src it gives, or a name per connection if it gives none, so clients
+    on different nodes never share an ID (and so a session). Whichever node
+    replies to a client, its reply goes over the peer connection to the
+    client's node, which hands it on.
+
+    Configured by RAFT_TCP_NODE (our ID), RAFT_TCP_PEERS (every node, as
+    n1=host:port,n2=host:port,...), and optionally RAFT_TCP_CLIENT
+    (host:port to listen for clients on)."""
+
+    def __init__(self, node_id, addresses, client_address=None, codec=codec,
+                 clock=time.time):
+        self.node_id = node_id
+        self.addresses = addresses  # Node IDs to (host, port)s, ours included
+        self.codec = codec
+        self.clock = clock
+        self.min_backoff = 0.05     # First redial delay, in seconds...
+        self.max_backoff = 2        # ...doubling up to this
+        self.max_buffer = 16 << 20  # Drop a down peer's backlog past this
+        self.peers = {}             # Node IDs to the connections we dialed
+        self.conns = {}             # Sockets to their connections
+        self.listeners = {}         # Listening sockets to whether they're
+                                    # for clients
+        self.clients = {}           # Client IDs to their connections
+        self.client_prefix = "tcp-" + node_id + "-"  # Starts our client IDs
+        self.next_client = 0        # For naming clients that don't say
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.dropped = 0            # Messages lost to down peers
+
+        self.listen(addresses[node_id], False)
+        if client_address:
+            self.listen(client_address, True)
+        # There's no Maelstrom to tell us who we are; do it ourselves
+        self.inbox = [{"src": "init", "dest": node_id, "body": {
+            "type": "raft_init", "msg_id": 0,
+            "node_id": node_id, "node_ids": sorted(addresses)}}]
+
+    def listen(self, address, clients):
+        """Starts accepting connections on address."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+        sock.listen(128)
+        sock.setblocking(False)
+        self.listeners[sock] = clients
+        log("Listening for", "clients" if clients else "peers", "on", address)
+
+    def dial(self, conn):
+        """Starts connecting to a peer, if it's time to retry."""
+        if conn.sock is not None or self.clock() < conn.retry_at:
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        err = sock.connect_ex(self.addresses[conn.peer])
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self.backoff(conn)
+            return
+        conn.sock = sock
+        conn.connecting = err != 0
+        self.conns[sock] = conn
+        if not conn.connecting:
+            log("Connected to", conn.peer)
+
+    def backoff(self, conn):
+        """Schedules the next redial of a peer, further off each time."""
+        conn.backoff = min(self.max_backoff, max(self.min_backoff, conn.backoff * 2))
+        conn.retry_at = self.clock() + conn.backoff
+
+    def drop(self, conn):
+        """Closes a broken connection. Whatever it had left to send may be
+        half-written, so it goes too; Raft will resend what matters."""
+        del self.conns[conn.sock]
+        conn.sock.close()
+        conn.sock = None
+        conn.connecting = False
+        conn.in_buffer = bytearray()
+        conn.out_buffer = bytearray()
+        if conn.peer is not None:
+            log("Lost connection to", conn.peer)
+            self.backoff(conn)
+        else:
+            for id in [id for id, c in self.clients.items() if c is conn]:
+                del self.clients[id]
+
+    def flush(self, conn):
+        """Sends as much of a connection's buffer as the socket will take."""
+        if conn.sock is None:
+            self.dial(conn)
+            if conn.sock is None and self.max_buffer < len(conn.out_buffer):
+                self.dropped += 1
+                conn.out_buffer = bytearray()
+            return
+        if conn.connecting or not conn.out_buffer:
+            return
+        try:
+            n = conn.sock.send(conn.out_buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (IOError, OSError):
+            self.drop(conn)
+            return
+        self.bytes_out += n
+        del conn.out_buffer[:n]
+
+    def write(self, msgs):
+        """Queues each message on its destination's connection, then sends
+        each connection everything at once."""
+        touched = []
+        for msg in msgs:
+            dest = msg["dest"]
+            if dest in self.addresses and dest != self.node_id:
+                conn = self.peers.get(dest)
+                if conn is None:
+                    conn = self.peers[dest] = TcpConnection(None, True, dest)
+            elif dest in self.clients:
+                conn = self.clients[dest]
+            elif self.client_node(dest) is not None:
+                # Another node's client; that node hands this on
+                node = self.client_node(dest)
+                conn = self.peers.get(node)
+                if conn is None:
+                    conn = self.peers[node] = TcpConnection(None, True, node)
+            else:
+                debug("No route to", dest)
+                continue
+            conn.queue(self.codec.dumps(msg))
+            touched.append(conn)
+        for conn in set(touched):
+            self.flush(conn)
+
+    def client_node(self, client):
+        """The other node a client of its is connected to, going by its ID, or
+        None."""
+        node = None
+        for id in self.addresses:
+            if id != self.node_id and client.startswith("tcp-" + id + "-") \
+                    and (node is None or len(node) < len(id)):
+                node = id
+        return node
+
+    def accept(self, listener):
+        """Accepts every pending connection on a listening socket."""
+        clients = self.listeners[listener]
+        while True:
+            try:
+                sock, address = listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.conns[sock] = TcpConnection(sock, not clients)
+            debug("Accepted connection from", address)
+
+    def receive(self, conn, msgs):
+        """Reads what's arrived on a connection, adding its messages to msgs."""
+        try:
+            data = conn.sock.recv(1 << 20)
+        except (BlockingIOError, InterruptedError):
+            return
+        except (IOError, OSError):
+            data = b""
+        if not data:
+            self.drop(conn)
+            return
+        self.bytes_in += len(data)
+        conn.in_buffer += data
+        try:
+            lines = conn.decode()
+        except IOError:
+            error("Bad frame; dropping connection", traceback.format_exc())
+            self.drop(conn)
+            return
+        for line in lines:
+            try:
+                msg = self.codec.loads(line)
+            except Exception:
+                error("Error decoding message!", traceback.format_exc())
+                continue
+            if conn.framed:
+                if msg.get("dest", self.node_id) != self.node_id:
+                    # A reply another node sent one of our clients
+                    self.write([msg])
+                    continue
+            else:
+                # A client: remember where to send its replies
+                if "src" in msg:
+                    msg["src"] = self.client_prefix + str(msg["src"])
+                else:
+                    # One name per connection, so retries over it look like
+                    # the same client, and sessions can spot them
+                    if conn.client_id is None:
+                        self.next_client += 1
+                        conn.client_id = self.client_prefix + "c" + str(self.next_client)
+                    msg["src"] = conn.client_id
+                msg.setdefault("dest", self.node_id)
+                self.clients[msg["src"]] = conn
+            msgs.append(msg)
+
+    def read(self, timeout):
+        """Waits up to timeout seconds (forever, if None) for messages from
+        peers and clients, sending buffered output as sockets allow, and
+        returns whatever arrived. Our input never closes."""
+        msgs = self.inbox
+        self.inbox = []
+        if msgs:
+            timeout = 0
+
+        # Redial peers with something to send once their backoff is up
+        waiting = [c for c in self.peers.values() if c.sock is None and c.out_buffer]
+        for conn in waiting:
+            self.dial(conn)
+        retries = [c.retry_at for c in waiting if c.sock is None]
+        if retries:
+            wait = max(0, min(retries) - self.clock())
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        readable = list(self.listeners) + list(self.conns)
+        writable = [s for s, c in self.conns.items() if c.connecting or c.out_buffer]
+        r, w, _ = select.select(readable, writable, [], timeout)
+
+        for sock in w:
+            conn = self.conns.get(sock)
+            if conn is None:
+                continue
+            if conn.connecting:
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    debug("Couldn't connect to", conn.peer, os.strerror(err))
+                    self.drop(conn)
+                    continue
+                conn.connecting = False
+                conn.backoff = 0
+                log("Connected to", conn.peer)
+            self.flush(conn)
+
+        for sock in r:
+            if sock in self.listeners:
+                self.accept(sock)
+            elif sock in self.conns:
+                self.receive(self.conns[sock], msgs)
+
+        return msgs, True
+
+    def close(self):
+        """Makes a last attempt to send whatever's buffered."""
+        for conn in self.peers.values():
+            if conn.sock is not None and not conn.connecting and conn.out_buffer:
+                conn.sock.setblocking(True)
+                try:
+                    conn.sock.sendall(conn.out_buffer)
+                except (IOError, OSError):
+                    pass
+
+
+def tcp_transport_from_env(clock=time.time):
+    """A TcpTransport configured by RAFT_TCP_NODE, RAFT_TCP_PEERS, and
+    RAFT_TCP_CLIENT."""
+    addresses = {}
+    for part in os.environ["RAFT_TCP_PEERS"].split(","):
+        node, address = part.split("=", 1)
+        addresses[node.strip()] = parse_address(address.strip())
+    client = os.environ.get("RAFT_TCP_CLIENT")
+    return TcpTransport(os.environ["RAFT_TCP_NODE"], addresses,
+                        parse_address(client) if client else None, clock=clock)
+
+
+class Net:
+    """Handles IO for sending and receiving messages: over stdin and stdout,
+    unless given another transport."""
+
+    def __init__(self, transport=None, clock=time.time):
         """Constructs a new network client."""
+        if transport is None:
+            if os.environ.get("RAFT_IO") == "threads":
+                transport = ThreadedStdioTransport()
+            elif os.environ.get("RAFT_IO") == "tcp":
+                transport = tcp_transport_from_env(clock)
+            else:
+                transport = StdioTransport()
+        self.transport = transport
+        self.clock = clock      # Returns the current time, in seconds
         self.node_id = None     # Our local node ID
         self.next_msg_id = 0    # The next message ID we're going to allocate
         self.handlers = {}      # A map of message types to handler functions
-        self.callbacks = {}     # A map of message IDs to response handlers
+        self.callbacks = {}     # A map of message IDs to [response handler,
+                                # timeout handler] pairs
+        self.deadlines = Timers()  # When each callback gives up, by message ID
+        self.rpc_timeout = 10   # Default seconds to wait for an RPC response
+        self.max_callbacks = 100000  # Time out the oldest RPCs past this many
+        self.expired = 0        # How many RPCs have timed out, all told
+        self.codec = codec      # How we encode messages, to size them up
+        self.out_buffer = []    # Messages waiting for flush()
+        self.msgs_in = 0        # Messages received, all told
+        self.msgs_out = 0       # Messages sent, all told
+        self.groups = {}        # Raft group IDs to their GroupNets, if we
+                                # host several groups
+        self.peers = set()      # The other nodes in the cluster
+        self.batch_peers = False  # Send each peer one message per flush?
+        self.peer_bodies = {}   # Peers to bodies waiting for that message
+        self.recorder = None    # Records what we receive, for replay later
+        if os.environ.get("RAFT_RECORD"):
+            self.recorder = Recorder(os.environ["RAFT_RECORD"], clock)
+            atexit.register(self.recorder.close)
 
     def set_node_id(self, id):
         self.node_id = id
 
+    def set_peers(self, peers):
+        """Tells us which destinations are other nodes, rather than clients."""
+        self.peers = set(peers)
+
     def new_msg_id(self):
         """Generate a fresh message ID"""
         id = self.next_msg_id
@@ -66,118 +975,772 @@ class Net:
 
     def send_msg(self, msg):
         """Sends a raw message object"""
-        log("Sent\n" + pformat(msg, width=128))
-        json.dump(msg, sys.stdout)
-        sys.stdout.write("\n")
-        sys.stdout.flush()
+        self.send_msgs([msg])
+
+    def send_msgs(self, msgs):
+        """Sends several raw message objects, once the next flush() hands
+        them to the transport. Don't change them after sending."""
+        for msg in msgs:
+            debug("Sent", Pretty(msg))
+            if self.batch_peers and msg["dest"] in self.peers:
+                self.peer_bodies.setdefault(msg["dest"], []).append(msg["body"])
+            else:
+                self.out_buffer.append(msg)
+        self.msgs_out += len(msgs)
+
+    def flush(self):
+        """Writes every buffered message out at once. If we're batching, each
+        peer gets everything for it in a single batch message."""
+        for dest, bodies in self.peer_bodies.items():
+            body = bodies[0] if len(bodies) == 1 else {"type": "batch", "msgs": bodies}
+            self.out_buffer.append({"src": self.node_id, "dest": dest, "body": body})
+        self.peer_bodies = {}
+        if self.out_buffer:
+            self.transport.write(self.out_buffer)
+            self.out_buffer = []
+
+    def close(self):
+        """Makes sure everything we've flushed gets written."""
+        self.transport.close()
+        if self.recorder:
+            self.recorder.close()
 
     def send(self, dest, body):
         """Sends a message to the given destination node with the given body."""
         self.send_msg({"src": self.node_id, "dest": dest, "body": body})
 
+    def send_batch(self, msgs):
+        """Sends a list of {dest, body} messages with a single write."""
+        self.send_msgs([{"src": self.node_id, "dest": m["dest"], "body": m["body"]} for m in msgs])
+
     def reply(self, req, body):
         """Replies to a given request message with a response body."""
         body["in_reply_to"] = req["body"]["msg_id"]
         self.send(req["src"], body)
 
-    def rpc(self, dest, body, handler):
-        """Sends an RPC request to dest and handles the response with handler."""
+    def rpc(self, dest, body, handler, timeout=None, on_timeout=None):
+        """Sends an RPC request to dest and handles the response with handler.
+        If no response arrives within timeout seconds, we forget about it and
+        call on_timeout, if given, with no arguments."""
+        if self.max_callbacks <= len(self.callbacks):
+            self.expire_callbacks(self.deadlines.next_deadline())
+
         msg_id = self.new_msg_id()
-        self.callbacks[msg_id] = handler
+        self.callbacks[msg_id] = [handler, on_timeout]
+        self.deadlines.set(msg_id, self.clock() + (timeout or self.rpc_timeout))
+        # A copy, since callers may share one body between several RPCs, and
+        # messages aren't encoded until we flush.
+        body = dict(body)
         body["msg_id"] = msg_id
         self.send(dest, body)
 
-    def process_msg(self):
-        """Handles a message from stdin, if one is currently available."""
-
-        # If we don't have anything to receive from stdin, we'll return None,
-        # and if we do get a message and process it, we'll return True.
-        if sys.stdin not in select.select([sys.stdin], [], [], 0)[0]:
-            return None
+    def next_deadline(self):
+        """When the next outstanding RPC times out, or None."""
+        return self.deadlines.next_deadline()
+
+    def expire_callbacks(self, now):
+        """Gives up on RPCs whose deadlines have passed by now."""
+        expired = self.deadlines.pop_due(now)
+        for msg_id in expired:
+            handler, on_timeout = self.callbacks.pop(msg_id)
+            if on_timeout:
+                on_timeout()
+        if expired:
+            self.expired += len(expired)
+            debug("Timed out", len(expired), "RPCs;", len(self.callbacks), "outstanding")
+        return expired
+
+    def process_msgs(self, timeout):
+        """Waits up to timeout seconds (forever, if None) for input, then
+        handles every complete message that's arrived. Returns False once our
+        input is closed."""
+        msgs, still_open = self.transport.read(timeout)
+        self.msgs_in += len(msgs)
+        if self.recorder and msgs:
+            self.recorder.record(msgs)
+        for msg in msgs:
+            try:
+                self.handle(msg)
+            except Exception:
+                error("Error handling message!", traceback.format_exc())
 
-        line = sys.stdin.readline()
-        if not line:
-            return None
+        return still_open
 
-        msg = json.loads(line)
-        log("Received\n" + pformat(msg, width=128))
+    def handle(self, msg):
+        """Dispatches a single parsed message to its reply or type handler."""
+        debug("Received", Pretty(msg))
         body = msg["body"]
 
         handler = None
         # Look up reply handler
         if "in_reply_to" in body:
             m = body["in_reply_to"]
-            handler = self.callbacks[m]
-            del self.callbacks[m]
+            if m not in self.callbacks:
+                debug("Ignoring reply to expired or unknown RPC", m)
+                return None
+            handler = self.callbacks.pop(m)[0]
+            self.deadlines.cancel(m)
+
+        # Unpack a peer's batch
+        elif body["type"] == "batch":
+            for b in body["msgs"]:
+                try:
+                    self.handle({"src": msg["src"], "dest": msg["dest"], "body": b})
+                except Exception:
+                    error("Error handling message!", traceback.format_exc())
+            return None
+
+        # Messages for one of our Raft groups go to its handlers
+        elif "group" in body and body["group"] in self.groups:
+            handler = self.groups[body["group"]].handlers.get(body["type"])
 
         # Fall back based on message type
         elif body["type"] in self.handlers:
             handler = self.handlers[body["type"]]
 
-        else:
+        if handler is None:
             raise RuntimeError("No callback or handler for\n" + pformat(msg, width=128))
 
         handler(msg)
-        return True
+
+
+class GroupNet:
+    """One Raft group's view of a Net it shares with other groups in the same
+    process. Whatever it sends to other nodes is tagged with its group, and
+    the Net routes tagged messages back to this group's handlers. Everything
+    else is the shared Net's."""
+
+    def __init__(self, net, group):
+        self.net = net
+        self.group = group
+        self.handlers = {}      # A map of message types to handler functions
+        net.groups[group] = self
+
+    def __getattr__(self, name):
+        return getattr(self.net, name)
+
+    def on(self, msg_type, handler):
+        """Register a callback for a message of the given type, in our group."""
+        if msg_type in self.handlers:
+            raise RuntimeError("already have a handler for message type " + msg_type)
+        self.handlers[msg_type] = handler
+
+    def handle(self, msg):
+        """Hands a message straight to our handler for its type."""
+        self.handlers[msg["body"]["type"]](msg)
+
+    def send(self, dest, body):
+        """Sends a message, tagged with our group if it's for another node."""
+        if dest in self.net.peers:
+            body["group"] = self.group
+        self.net.send(dest, body)
+
+    def send_batch(self, msgs):
+        """Sends a list of {dest, body} messages with a single write."""
+        for m in msgs:
+            if m["dest"] in self.net.peers:
+                m["body"]["group"] = self.group
+        self.net.send_batch(msgs)
+
+    def reply(self, req, body):
+        """Replies to a given request message with a response body."""
+        body["in_reply_to"] = req["body"]["msg_id"]
+        self.send(req["src"], body)
+
+    def rpc(self, dest, body, handler, timeout=None, on_timeout=None):
+        """Sends an RPC request to another node in our group."""
+        body["group"] = self.group
+        self.net.rpc(dest, body, handler, timeout, on_timeout)
+
+
+class TermIndex:
+    """Remembers the index where each term's run of entries begins in a log.
+    Terms only increase along a Raft log, so we can binary search for the
+    first or last entry of a term."""
+
+    def __init__(self, start, term):
+        self.terms = [term]     # The term of each run
+        self.starts = [start]   # The first index of each run
+
+    def append(self, index, term):
+        """Notes that the entry at index has term."""
+        if term != self.terms[-1]:
+            self.terms.append(term)
+            self.starts.append(index)
+
+    def truncate(self, size):
+        """Forgets runs past index size."""
+        while 1 < len(self.starts) and size < self.starts[-1]:
+            self.terms.pop()
+            self.starts.pop()
+
+    def compact(self, start):
+        """Forgets runs that end before start."""
+        i = bisect.bisect_right(self.starts, start) - 1
+        del self.terms[:i]
+        del self.starts[:i]
+        self.starts[0] = start
+
+    def find(self, term):
+        """The position of term's run, or None if we have no such term."""
+        i = bisect.bisect_left(self.terms, term)
+        if i < len(self.terms) and self.terms[i] == term:
+            return i
+
+    def first_index(self, term):
+        """The first index with the given term, or None."""
+        i = self.find(term)
+        if i is not None:
+            return self.starts[i]
+
+    def last_index(self, term, size):
+        """The last index with the given term in a log of size entries, or None."""
+        i = self.find(term)
+        if i is not None:
+            if i + 1 < len(self.starts):
+                return self.starts[i + 1] - 1
+            return size
+
+
+class Entry:
+    """A log entry, as handed out by Log. Subscripting (e["term"]) works too, so
+    these can stand in for the dicts entries travel over the network as."""
+
+    __slots__ = ("term", "op")
+
+    def __init__(self, term, op):
+        self.term = term
+        self.op = op
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def to_dict(self):
+        """This entry as a dict, for the wire."""
+        return {"term": self.term, "op": self.op}
+
+
+class LogView:
+    """A read-only window onto log entries lo through hi, which reads them from
+    the log rather than copying them. It sees the log as it is when read, so use
+    it before the log next changes."""
+
+    __slots__ = ("log", "lo", "hi")
+
+    def __init__(self, log, lo, hi):
+        self.log = log
+        self.lo = lo
+        self.hi = max(hi, lo - 1)
+
+    def __len__(self):
+        return self.hi - self.lo + 1
+
+    def __iter__(self):
+        for i in range(self.lo, self.hi + 1):
+            yield self.log.get(i)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            start, stop, step = k.indices(len(self))
+            if step != 1:
+                raise ValueError("log views don't support steps")
+            return LogView(self.log, self.lo + start, self.lo + stop - 1)
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError("log view index out of range")
+        return self.log.get(self.lo + k)
+
+    def ops(self):
+        """The ops of these entries."""
+        return [self.log.op(i) for i in range(self.lo, self.hi + 1)]
+
+    def to_dicts(self):
+        """These entries as dicts, for the wire."""
+        return [{"term": self.log.term(i), "op": self.log.op(i)}
+                for i in range(self.lo, self.hi + 1)]
 
 
 class Log:
-    """Stores Raft entries, which are dicts with a :term field."""
+    """Stores Raft entries: their terms in an array, next to a list of their
+    ops. Entries before index `start` have been compacted away into a snapshot;
+    the entry at `start` stays behind as a placeholder carrying the snapshot's
+    last term."""
 
     def __init__(self):
         """Construct a new Log"""
         # Note that we provide a default entry here, which simplifies
         # some default cases involving empty logs.
-        self.entries = [{"term": 0, "op": None}]
+        self.start = 1                      # The index of terms[0]
+        self.terms = array.array("q", [0])  # The term of each entry
+        self.ops = [None]                   # The op of each entry
+        self.sizes = array.array("q", [0])  # Each op's encoded size, or -1
+                                            # until someone asks
+        self.term_index = TermIndex(1, 0)
 
     def get(self, i):
         """Return a log entry by index. Note that Raft's log is 1-indexed."""
-        return self.entries[i - 1]
+        return Entry(self.term(i), self.op(i))
+
+    def term(self, i):
+        """The term of the entry at index i. Cheaper than get(i)["term"]."""
+        if i < self.start:
+            raise IndexError("entry " + str(i) + " has been compacted")
+        return self.terms[i - self.start]
+
+    def op(self, i):
+        """The op of the entry at index i."""
+        if i < self.start:
+            raise IndexError("entry " + str(i) + " has been compacted")
+        return self.ops[i - self.start]
+
+    def op_size(self, i):
+        """How many bytes the op at index i takes, encoded. We encode each op
+        at most once to find out."""
+        n = self.sizes[i - self.start]
+        if n < 0:
+            n = self.sizes[i - self.start] = len(codec.dumps(self.op(i)))
+        return n
 
     def append(self, entries):
         """Appends multiple entries to the log."""
-        self.entries.extend(entries)
-        # log("Log:\n" + pformat(self.entries, width=128))
+        index = self.size()
+        for e in entries:
+            index += 1
+            self.terms.append(e["term"])
+            self.ops.append(e["op"])
+            self.sizes.append(-1)
+            self.term_index.append(index, e["term"])
 
     def last(self):
         """Returns the most recent entry"""
-        return self.entries[-1]
+        return self.get(self.size())
 
     def last_term(self):
         """What's the term of the last entry in the log?"""
-        l = self.last()
-        if l:
-            return l['term']
-        else:
-            return 0
+        return self.terms[-1]
 
     def size(self):
         "How many entries are in the log?"
-        return len(self.entries)
+        return self.start + len(self.terms) - 1
 
     def truncate(self, size):
         """Truncate the log to this many entries."""
-        self.entries = self.entries[0:size]
+        if size < self.start:
+            raise LookupError("can't truncate compacted entries, to " + str(size))
+        del self.terms[size - self.start + 1:]
+        del self.ops[size - self.start + 1:]
+        del self.sizes[size - self.start + 1:]
+        self.term_index.truncate(size)
+
+    def slice(self, i, j):
+        """Entries from index i up to and including j, as a LogView"""
+        if i <= 0 or i < self.start:
+            raise LookupError("illegal index " + str(i))
+        return LogView(self, i, min(j, self.size()))
+
+    def compact(self, i):
+        """Discards every entry before index i, which becomes the placeholder."""
+        if i <= self.start:
+            return
+        del self.terms[:i - self.start]
+        del self.ops[:i - self.start]
+        del self.sizes[:i - self.start]
+        self.ops[0] = None
+        self.start = i
+        self.term_index.compact(i)
+
+    def reset(self, i, term):
+        """Throws away the whole log, leaving a placeholder at index i with the
+        given term. Used when a snapshot supersedes everything we have."""
+        self.start = i
+        self.terms = array.array("q", [term])
+        self.ops = [None]
+        self.sizes = array.array("q", [0])
+        self.term_index = TermIndex(i, term)
+
+    def first_index_of_term(self, term):
+        """The first index we have with this term, or None."""
+        return self.term_index.first_index(term)
+
+    def last_index_of_term(self, term):
+        """The last index we have with this term, or None."""
+        return self.term_index.last_index(term, self.size())
+
+    def sync(self):
+        """Makes everything appended so far durable. Nothing to do in memory."""
+        pass
+
+
+class Segment:
+    """An append-only file of log records, the first of which has log index
+    `first`. Each record is a (term, length) header followed by the entry's op
+    as JSON, so terms can be read back without decoding ops."""
+
+    MAGIC = b"RAFTSEG1"
+    RECORD = struct.Struct("<qI")
+
+    def __init__(self, path, first):
+        self.path = path
+        self.first = first
+        self.file = None        # Open for reading and appending
+        self.map = None         # Read-only mmap of (a prefix of) the file
+        self.size = 0           # Bytes in the file, including buffered writes
+
+    def create(self):
+        """Starts a new, empty segment file."""
+        self.file = open(self.path, "w+b")
+        self.file.write(self.MAGIC)
+        self.size = len(self.MAGIC)
+
+    def scan(self):
+        """Opens an existing segment and returns (term, offset, length) for
+        each record, where offset is that of the op. A torn record at the end,
+        from a crash mid-write, is cut off."""
+        self.file = open(self.path, "r+b")
+        self.size = os.fstat(self.file.fileno()).st_size
+        if self.size < len(self.MAGIC):
+            self.truncate(0)
+            self.file.write(self.MAGIC)
+            self.size = len(self.MAGIC)
+            return []
+
+        self.remap()
+        records = []
+        offset = len(self.MAGIC)
+        while offset + self.RECORD.size <= self.size:
+            term, length = self.RECORD.unpack_from(self.map, offset)
+            if self.size < offset + self.RECORD.size + length:
+                break
+            records.append((term, offset + self.RECORD.size, length))
+            offset += self.RECORD.size + length
+
+        if offset < self.size:
+            log("Truncating torn record at", self.path, "offset", offset)
+            self.truncate(offset)
+        self.file.seek(self.size)
+        return records
+
+    def append(self, term, data):
+        """Buffers a record, returning the offset of its data."""
+        self.file.write(self.RECORD.pack(term, len(data)))
+        self.file.write(data)
+        self.size += self.RECORD.size + len(data)
+        return self.size - len(data)
+
+    def remap(self):
+        """Maps everything written so far."""
+        self.file.flush()
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, offset, length):
+        """Reads length bytes at offset."""
+        if self.map is None or len(self.map) < offset + length:
+            self.remap()
+        return self.map[offset:offset + length]
 
-    def from_index(self, i):
-        """All entries from index i on"""
-        if i <= 0:
-            raise LookupError("illegal index " + i)
-        return self.entries[i - 1:]
+    def truncate(self, size):
+        """Cuts the file down to size bytes."""
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.flush()
+        self.file.truncate(size)
+        self.file.seek(size)
+        self.size = size
+
+    def sync(self):
+        """Flushes and fsyncs everything written so far."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def remove(self):
+        """Closes and deletes the segment file."""
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+        os.remove(self.path)
+
+
+class DurableLog(Log):
+    """A Log kept in a directory of append-only segment files. Terms and record
+    locations stay in memory, the locations standing in for Log's op list; ops
+    are decoded from mmapped segments on demand.
+    Appends are only buffered until sync(), which fsyncs every segment written
+    since the last sync, so one fsync covers a whole tick's worth of entries."""
+
+    def __init__(self, path, start=1, start_term=0, segment_bytes=4 << 20):
+        """Opens (creating, if need be) the log in path. start and start_term
+        describe the snapshot we recovered, if any; entries up to start are
+        covered by it."""
+        self.path = path
+        self.segment_bytes = segment_bytes  # Roll to a new segment past this
+        self.start = start
+        self.terms = array.array("q", [start_term])
+        self.locs = [None]      # (segment, offset, length) of each entry's op
+        self.term_index = TermIndex(start, start_term)
+        self.segments = []      # Segments, oldest first
+        self.dirty = set()      # Segments written since the last sync
+        self.dir_dirty = False  # Have we created or removed segment files?
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.recover()
+
+    def recover(self):
+        """Rebuilds terms and locations from the record headers on disk."""
+        names = sorted(n for n in os.listdir(self.path) if n.endswith(".seg"))
+        start_term = self.terms[0]
+        next_index = None   # The index the next segment should start at
+        stale = False       # Does the log disagree with our snapshot?
+        for name in names:
+            seg = Segment(os.path.join(self.path, name), int(name[:-4]))
+            if next_index is None and self.start + 1 < seg.first \
+                    or next_index is not None and seg.first != next_index:
+                # A gap in the log; nothing from here on is usable.
+                log("Discarding segment", seg.path, "after a gap in the log")
+                os.remove(seg.path)
+                self.dir_dirty = True
+                continue
+
+            records = seg.scan()
+            next_index = seg.first + len(records)
+            for i, (term, offset, length) in enumerate(records):
+                index = seg.first + i
+                if index == self.start and 1 < index and term != start_term:
+                    stale = True
+            if next_index <= self.start + 1:
+                # Nothing here past our snapshot. We may have crashed after
+                # saving the snapshot but before resetting the log; keeping
+                # this segment would put our next append at the wrong index.
+                os.remove(seg.path)
+                self.dir_dirty = True
+                continue
+
+            self.segments.append(seg)
+            for i, (term, offset, length) in enumerate(records):
+                index = seg.first + i
+                if self.start < index:
+                    self.terms.append(term)
+                    self.locs.append((seg, offset, length))
+                    self.term_index.append(index, term)
+
+        if stale:
+            # Left over from before we installed a leader's snapshot.
+            log("Log disagrees with snapshot at", self.start, "; discarding it")
+            self.reset(self.start, start_term)
+
+        log("Recovered log", self.start, "to", self.size(), "from", len(self.segments), "segments")
+
+    def op(self, i):
+        """The op of the entry at index i, read back from its segment."""
+        if i < self.start:
+            raise IndexError("entry " + str(i) + " has been compacted")
+        loc = self.locs[i - self.start]
+        if loc is None:
+            return None
+        seg, offset, length = loc
+        return codec.loads(seg.read(offset, length))
+
+    def op_size(self, i):
+        """How many bytes the op at index i takes, encoded: its record's
+        length, so we needn't read it."""
+        if i < self.start:
+            raise IndexError("entry " + str(i) + " has been compacted")
+        loc = self.locs[i - self.start]
+        return 0 if loc is None else loc[2]
+
+    def append(self, entries):
+        """Appends multiple entries to the log."""
+        for e in entries:
+            seg = self.segments[-1] if self.segments else None
+            if seg is None or self.segment_bytes <= seg.size:
+                seg = Segment(os.path.join(self.path, "%020d.seg" % (self.size() + 1)), self.size() + 1)
+                seg.create()
+                self.segments.append(seg)
+                self.dir_dirty = True
+
+            data = codec.dumps(e["op"])
+            self.locs.append((seg, seg.append(e["term"], data), len(data)))
+            self.terms.append(e["term"])
+            self.term_index.append(self.size(), e["term"])
+            self.dirty.add(seg)
+
+    def truncate(self, size):
+        """Truncate the log to this many entries."""
+        if size < self.start:
+            raise LookupError("can't truncate compacted entries, to " + str(size))
+        keep = size - self.start + 1
+        if len(self.terms) <= keep:
+            return
+
+        seg, offset, length = self.locs[keep]
+        seg.truncate(offset - Segment.RECORD.size)
+        self.dirty.add(seg)
+        while self.segments[-1] is not seg:
+            self.remove_segment(self.segments.pop())
+        del self.terms[keep:]
+        del self.locs[keep:]
+        self.term_index.truncate(size)
+
+    def compact(self, i):
+        """Discards every entry before index i, which becomes the placeholder,
+        and removes segments holding nothing past it."""
+        if i <= self.start:
+            return
+        del self.terms[:i - self.start]
+        del self.locs[:i - self.start]
+        self.locs[0] = None
+        self.start = i
+        self.term_index.compact(i)
+        while 1 < len(self.segments) and self.segments[1].first <= i + 1:
+            self.remove_segment(self.segments.pop(0))
+
+    def reset(self, i, term):
+        """Throws away the whole log, leaving a placeholder at index i with the
+        given term. Used when a snapshot supersedes everything we have."""
+        while self.segments:
+            self.remove_segment(self.segments.pop())
+        self.start = i
+        self.terms = array.array("q", [term])
+        self.locs = [None]
+        self.term_index = TermIndex(i, term)
+
+    def remove_segment(self, seg):
+        """Deletes a segment we no longer need."""
+        self.dirty.discard(seg)
+        seg.remove()
+        self.dir_dirty = True
+
+    def sync(self):
+        """Fsyncs every segment written since the last sync."""
+        for seg in self.dirty:
+            seg.sync()
+        self.dirty.clear()
+        if self.dir_dirty:
+            fsync_dir(self.path)
+            self.dir_dirty = False
+
+
+def op_problem(op):
+    """What's wrong with a client's read, write, cas, or txn, or None if it's
+    fine to append. Every node applies what we append, so we check first."""
+    if op["type"] == "txn":
+        return txn_problem(op.get("txn"))
+    if not isinstance(op.get("key"), (int, str)):
+        return "key must be an integer or a string"
+    if op["type"] == "write" and "value" not in op:
+        return "write needs a value"
+    if op["type"] == "cas" and not ("from" in op and "to" in op):
+        return "cas needs from and to"
+    return None
+
+
+def txn_problem(txn):
+    """What's wrong with a transaction's micro-ops, or None if they're fine.
+    We check before a txn goes anywhere near the log, since every node will
+    apply it."""
+    if not isinstance(txn, list):
+        return "txn must be a list of micro-ops"
+    for mop in txn:
+        if not (isinstance(mop, list) and len(mop) == 3):
+            return "micro-ops must be [f, key, value] triples"
+        if not isinstance(mop[1], (int, str)):
+            return "keys must be integers or strings"
+        if mop[0] == "cas":
+            if not (isinstance(mop[2], list) and len(mop[2]) == 2):
+                return "cas micro-ops take [from, to]"
+        elif mop[0] not in ("r", "w"):
+            return "unknown micro-op " + str(mop[0])
+    return None
 
 
 class KVStore:
-    """A state machine providing a key-value store."""
-    def __init__(self):
+    """A state machine providing a key-value store. It remembers its responses
+    to recent client requests, by client and msg_id, so a request that's
+    retried, or appended twice, gets its original response instead of being
+    applied again. Since that memory is part of the state machine, every
+    replica agrees on it, and it survives snapshots and leader changes."""
+    def __init__(self, max_sessions=10000):
         self.state = {}
+        self.sessions = collections.OrderedDict()
+                                # (client, msg_id)s to the response bodies we
+                                # gave, least recently applied first
+        self.max_sessions = max_sessions  # How many responses to remember
+        self.duplicates = 0     # Duplicates we answered without applying
+
+    def cached(self, op):
+        """Our response to an earlier copy of op, if we remember one."""
+        return self.sessions.get((op.get("client"), op["msg_id"]))
+
+    def read_only(self, op):
+        """Does op leave the state alone?"""
+        return op["type"] == "read" or \
+            (op["type"] == "txn" and all(mop[0] == "r" for mop in op["txn"]))
+
+    def apply_txn(self, txn):
+        """Applies a transaction's micro-ops in order, as one step: reads
+        ["r", k, None], writes ["w", k, v], and compare-and-sets
+        ["cas", k, [from, to]]. Reads see the txn's own earlier writes. If any
+        cas fails, nothing is written. Returns the response body, with reads
+        filled in."""
+        writes = {}
+        done = []
+        for f, k, v in txn:
+            if f == "r":
+                done.append([f, k, writes[k] if k in writes else self.state.get(k)])
+                continue
+            if f == "cas":
+                if k not in writes and k not in self.state:
+                    return {"type": "error", "code": 20, "text": "not found: " + str(k)}
+                current = writes[k] if k in writes else self.state[k]
+                if current != v[0]:
+                    return {
+                        "type": "error",
+                        "code": 22,
+                        "text": "expected " + str(v[0]) + " at " + str(k) +
+                                " but had " + str(current),
+                        }
+                writes[k] = v[1]
+            else:
+                writes[k] = v
+            done.append([f, k, v])
+        self.state.update(writes)
+        return {"type": "txn_ok", "txn": done}
 
     def apply(self, op):
-        """Applies an op to the state machine, and returns a response message"""
+        """Applies an op to the state machine, and returns a response message.
+        An op that can't be applied gets an error response instead: it's in
+        the log, so every replica has to get past it."""
+        try:
+            return self.apply_op(op)
+        except Exception:
+            error("Couldn't apply", Pretty(op), traceback.format_exc())
+            return {"dest": op.get("client"), "body": {
+                "type": "error",
+                "code": 12,
+                "text": "couldn't apply op",
+                "in_reply_to": op.get("msg_id"),
+                }}
+
+    def apply_op(self, op):
         t = op["type"]
-        k = op["key"]
+        k = op.get("key")
+        read_only = self.read_only(op)
+        if not read_only:
+            session = (op["client"], op["msg_id"])
+            if session in self.sessions:
+                self.duplicates += 1
+                self.sessions.move_to_end(session)
+                return {"dest": op["client"], "body": self.sessions[session]}
 
         # Handle state transition
-        if t == "read":
+        if t == "txn":
+            res = self.apply_txn(op["txn"])
+        elif t == "read":
             if k in self.state:
                 res = {"type": "read_ok", "value": self.state[k]}
             else:
@@ -198,26 +1761,109 @@ class KVStore:
                 self.state[k] = op["to"]
                 res = {"type": "cas_ok"}
 
-        log("KV:\n" + pformat(self.state, width=128))
+        debug("KV:", Pretty(self.state))
 
         # Construct response
         res["in_reply_to"] = op["msg_id"]
+        if not read_only:
+            # Reads are safe to repeat; remember everything else
+            self.sessions[session] = res
+            if self.max_sessions < len(self.sessions):
+                self.sessions.popitem(last=False)
         return {"dest": op["client"], "body": res}
 
+    def apply_batch(self, ops):
+        """Applies ops in order, and returns their response messages"""
+        return [self.apply(op) for op in ops]
+
+    def snapshot(self):
+        """Returns a copy of the state, suitable for sending to another node.
+        We use [key, value] pairs, since JSON objects would stringify keys,
+        and [client, msg_id, response] triples for sessions."""
+        return {
+            "kv": [[k, v] for k, v in self.state.items()],
+            "sessions": [[c, m, res] for (c, m), res in self.sessions.items()],
+            }
+
+    def restore(self, snapshot):
+        """Replaces our state with a snapshot. Snapshots from before we kept
+        sessions are just the [key, value] pairs."""
+        if isinstance(snapshot, list):
+            snapshot = {"kv": snapshot, "sessions": []}
+        self.state = {k: v for k, v in snapshot["kv"]}
+        self.sessions = collections.OrderedDict(
+            ((c, m), res) for c, m, res in snapshot["sessions"])
+
+
+class EventLoop:
+    """The mainloop, for anything with a net, a tick(), and a wait_time()."""
+
+    def step(self, timeout):
+        """One turn of the mainloop: handles whatever arrives within timeout
+        seconds, then ticks. Returns False once our input is closed."""
+        try:
+            if not self.net.process_msgs(timeout):
+                return False
+            self.tick()
+            return True
+        finally:
+            self.net.flush()
 
-class RaftNode:
-    def __init__(self):
+    def main(self):
+        """Mainloop"""
+        log("Online.")
+
+        while True:
+            try:
+                if not self.step(self.wait_time()):
+                    log("Stdin closed; shutting down.")
+                    break
+
+            except KeyboardInterrupt:
+                log("Aborted by interrupt!")
+                break
+            except:
+                error("Error!", traceback.format_exc())
+        self.net.close()
+
+
+class RaftNode(EventLoop):
+    def __init__(self, clock=time.time, transport=None, net=None, group=None):
+        """A node that reads the time from clock and exchanges messages over
+        transport; by default, the system clock and stdin/stdout. As one of
+        several groups in a MultiRaft, it's given the group's net instead."""
+        self.clock = clock
+        self.group = group              # Our Raft group, if we're one of several
         # Heartbeats & timeouts
-        self.election_timeout = 2       # Time before election, in seconds
-        self.election_deadline = 0      # Next election, in epoch seconds
+        self.min_election_timeout = float(os.environ.get("RAFT_ELECTION_TIMEOUT_MIN", 0.3))
+        self.max_election_timeout = float(os.environ.get("RAFT_ELECTION_TIMEOUT_MAX", 2))
+                                        # Bounds on the election timeout
+        self.election_rtts = 10         # Election timeout, in RTT timeouts
+        self.max_timing_step = 1.5      # Most one retuning scales it by
+        self.election_timeout = self.min_election_timeout
+                                        # Time before election, in seconds;
+                                        # the leader tunes it to the network
+        self.heartbeat_interval = self.election_timeout / 4
+                                        # Time between heartbeats, in seconds
+        self.rtt = {}                   # Map of nodes to their [smoothed RTT,
+                                        # RTT deviation], as measured by leaders
+        self.adopted_timeouts = {}      # Voters to (sent time, election
+                                        # timeout) of the latest append of
+                                        # ours they've acknowledged
         self.min_replication_interval = 0.05  # Don't replicate TOO frequently
         self.election_deadline = 0      # Next election, in epoch seconds
         self.step_down_deadline = 0     # When to step down automatically
         self.last_replication = 0       # Last replication, in epoch seconds
+        self.heartbeat_requested = False  # Send a heartbeat round ASAP?
+        self.shared_heartbeats = False  # Does a MultiRaft time our heartbeats?
+        self.replication_requested = False  # Send new entries ASAP?
+        self.timers = Timers()          # Deadlines the mainloop wakes up for
 
         # Node & cluster IDS
         self.node_id = None       # Our node ID
-        self.node_ids = None      # The set of node IDs
+        self.node_ids = None      # The set of node IDs, voters then learners
+        self.learners = set()     # Members who get the log, but don't vote
+                                  # or count towards quorums
 
         # Raft state
         self.state = "nascent"    # One of nascent, follower, candidate, or leader
@@ -226,47 +1872,398 @@ class RaftNode:
         self.commit_index = 0     # The highest committed entry in the log
         self.last_applied = 1     # The last entry we applied to the state machine
         self.leader = None        # Who do we think the leader is?
+        self.preferred_leader = None  # Who should lead our group, if anyone
+        self.last_leader_contact = 0  # When we last heard from a valid leader
+
+        # Log compaction
+        self.snapshot_interval = 1000  # Applied entries between snapshots
+        self.snapshot = None      # Our latest snapshot: index, term, and state
+
+        # Durability
+        self.data_dir = None      # Where we persist state, if anywhere
+        self.unsynced_replies = []  # Replies waiting on the next log sync
 
         # Leader state
         self.next_index = None    # A map of nodes to the next index to replicate
         self._match_index = None  # Map of nodes to the highest log entry known
                                   # to be replicated on that node.
+        self.match_quorum = None  # Those match indices, plus our own durable
+                                  # log size, as a QuorumTracker.
+        self.acked_at = None      # Map of nodes to the send time of the latest
+                                  # message they've acknowledged this term.
+        self.in_flight = None     # Map of nodes to the appends we've sent them
+                                  # and not heard back about, oldest first.
+
+        # Replication pipelining
+        self.max_in_flight = 8    # Outstanding appends with entries, per follower
+        self.max_append_entries = 512  # Most entries in one append
+        self.max_append_bytes = 1 << 20  # Roughly the most op bytes in one append
+        self.append_timeout = 1   # Resend appends unacknowledged for this long
+        self.vote_timeout = 1     # Give up on vote requests after this long
+
+        # Elections
+        self.pre_vote = os.environ.get("RAFT_PRE_VOTE", "1") != "0"
+                                  # Poll for votes before standing for election?
+        self.transfer_target = None  # Who we're handing leadership to, if
+                                  # anyone; ourselves, if it's being handed to us
+        self.transfer_deadline = 0  # When to give up on that handoff
+        self.timeout_now_sent = False  # Have we told the target to stand yet?
+        self.transfer_aborted = 0   # When we last gave up on a handoff after
+                                    # telling the target to stand
+        self.next_rebalance = 0   # Don't hand leadership to our group's
+                                  # preferred leader before this time
+
+        # Membership changes
+        self.max_learner_lag = 100  # How many entries behind a learner can be
+                                  # and still be promoted to voter
+        self.promote_timeout = 30  # Give up waiting for a learner after this
+        self.promotions = []      # [deadline, request]s to promote learners
+                                  # once they've caught up
+
+        # Reads
+        self.read_mode = os.environ.get("RAFT_READ_MODE", "lease")
+                                  # lease, read_index, or log
+        self.lease_duration = self.min_election_timeout * 0.9
+                                  # How long a quorum ack keeps us leader,
+                                  # leaving some margin for clock drift. The
+                                  # election timeout moves, but never below
+                                  # its minimum.
+        self.pending_reads = []   # Reads waiting on a read index: [time, index, op]
+
+        # Client requests
+        self.client_msgs = []     # Requests that arrived this tick, to append
+                                  # or forward all at once
+        self.appended_ops = collections.OrderedDict()
+                                  # (client, msg_id)s of ops we've appended as
+                                  # leader but not applied, to their indices
+
+        # Statistics
+        self.counters = collections.Counter()  # Elections, step-downs, etc.
+        self.latencies = collections.defaultdict(Histogram)
+                                  # Per-phase client op latencies, by phase
+        self.traces = {}          # Log index to the (received, appended)
+                                  # times of client ops we appended as leader
+        self.commit_times = collections.deque()
+                                  # (commit index, time)s since the last apply
+        self.stats_file = os.environ.get("RAFT_STATS_FILE")
+                                  # Where to dump stats periodically, if anywhere
+        self.stats_interval = float(os.environ.get("RAFT_STATS_INTERVAL", 10))
+        self.next_stats_dump = 0  # When to dump stats next
 
         # Components
-        self.net = Net()
+        self.net = net or Net(transport, clock)
         self.log = Log()
         self.state_machine = KVStore()
         self.setup_handlers()
 
     def other_nodes(self):
-        """All nodes except this one."""
+        """All nodes except this one, learners included."""
         nodes = list(self.node_ids)
         nodes.remove(self.node_id)
         return nodes
 
+    def voters(self):
+        """The nodes that elect leaders and make up quorums."""
+        return [n for n in self.node_ids if n not in self.learners]
+
+    def other_voters(self):
+        """All voters except this one."""
+        return [n for n in self.voters() if n != self.node_id]
+
     def match_index(self):
-        """Returns the map of match indices, including an entry for ourselves, based on our log size."""
-        m = dict(self._match_index)
+        """Returns the map of voters' match indices, including an entry for
+        ourselves, based on our log size."""
+        m = dict((n, i) for n, i in self._match_index.items() if n not in self.learners)
         m[self.node_id] = self.log.size()
         return m
 
+    def set_match_index(self, node, i):
+        """Notes that node has replicated our log up to i, and commits
+        whatever that lets us commit."""
+        if self._match_index[node] < i:
+            self._match_index[node] = i
+            if node not in self.learners:
+                self.match_quorum.update(node, i)
+                self.advance_commit_index()
+
     def set_node_id(self, id):
         """Assign our node ID."""
         self.node_id = id
         self.net.set_node_id(id)
 
-    def brpc(self, body, handler):
-        """Broadcast an RPC message to all other nodes, and call handler with each response."""
-        for node in self.other_nodes():
-            self.net.rpc(node, body, handler)
+    def init(self, node_id, node_ids, learners=None):
+        """Learns who we are and who else is in the cluster, recovers any
+        state we persisted, and starts out as a follower. Learners, if not
+        given, come from RAFT_LEARNERS."""
+        self.set_node_id(node_id)
+        if learners is None:
+            learners = os.environ.get("RAFT_LEARNERS", "").split(",")
+        self.set_config([n for n in node_ids if n not in learners],
+                        [n for n in node_ids if n in learners])
+        if self.group is not None:
+            # Spread the groups' leaders across the nodes
+            self.preferred_leader = node_ids[self.group % len(node_ids)]
+
+        if os.environ.get("RAFT_DATA_DIR"):
+            path = os.path.join(os.environ["RAFT_DATA_DIR"], self.node_id)
+            if self.group is not None:
+                path = os.path.join(path, "g" + str(self.group))
+            self.open_storage(path)
+
+        self.become_follower()
+
+    def open_storage(self, path):
+        """Recovers our term, vote, snapshot, and log from path, and keeps
+        them there from now on."""
+        self.data_dir = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        state_file = os.path.join(path, "state.json")
+        if os.path.exists(state_file):
+            with open(state_file, "rb") as f:
+                state = json.loads(f.read().decode("utf-8"))
+            self.current_term = state["term"]
+            self.voted_for = state["voted_for"]
+
+        snapshot_file = os.path.join(path, "snapshot.json")
+        if os.path.exists(snapshot_file):
+            with open(snapshot_file, "rb") as f:
+                self.snapshot = codec.loads(f.read())
+            self.state_machine.restore(self.snapshot["state"])
+            if "config" in self.snapshot:
+                self.set_config(*self.snapshot["config"])
+            self.commit_index = self.snapshot["index"]
+            self.last_applied = self.snapshot["index"]
+            self.log = DurableLog(os.path.join(path, "log"),
+                    self.snapshot["index"], self.snapshot["term"])
+        else:
+            self.log = DurableLog(os.path.join(path, "log"))
+
+        log("Recovered term", self.current_term, "voted for", self.voted_for,
+            "applied up to", self.last_applied)
+
+    def set_config(self, voters, learners):
+        """Adopts a cluster configuration: voters, who elect leaders and make
+        up quorums, and learners, who only receive the log. As the leader, we
+        start or stop replicating to whoever joined or left."""
+        self.node_ids = list(voters) + list(learners)
+        self.learners = set(learners)
+        # Nodes that leave are still nodes, not clients
+        self.net.set_peers(self.net.peers.union(
+            n for n in self.node_ids if n != self.node_id))
+
+        if self.state == "leader":
+            others = self.other_nodes()
+            for n in others:
+                if n not in self.next_index:
+                    self.next_index[n] = self.log.size() + 1
+                    self._match_index[n] = 0
+                    self.acked_at[n] = 0
+                    self.in_flight[n] = collections.deque()
+            for n in list(self.next_index):
+                if n not in others:
+                    for m in (self.next_index, self._match_index, self.acked_at, self.in_flight):
+                        del m[n]
+            self.match_quorum = QuorumTracker(self.match_index())
+            self.advance_commit_index()
+
+    def config_change_pending(self):
+        """Is there a configuration change we can't build on yet? We allow one
+        at a time, and only once we've committed an entry of our own term, so
+        we know no earlier leader's change is still in flight."""
+        if self.commit_index < self.log.start \
+                or self.log.term(self.commit_index) != self.current_term:
+            return True
+        ops = self.log.slice(self.last_applied + 1, self.log.size()).ops()
+        return any(op["type"] == "config" for op in ops)
+
+    def change_config(self, msg, voters, learners):
+        """As the leader, appends a configuration change, which takes effect
+        once it's committed and applied, and answers msg then."""
+        op = {
+            "type": "config",
+            "voters": voters,
+            "learners": learners,
+            "client": msg["src"],
+            "msg_id": msg["body"]["msg_id"],
+            "reply": msg["body"]["type"] + "_ok",
+            }
+        self.log.append([{"term": self.current_term, "op": op}])
+        self.replication_requested = True
+        log("Changing configuration to voters", voters, "learners", learners)
+
+    def apply_config(self, op):
+        """Applies a committed configuration change, returning its reply."""
+        self.set_config(op["voters"], op["learners"])
+        self.counters["config_changes"] += 1
+        log("Configuration now voters", op["voters"], "learners", op["learners"])
+        return {"dest": op["client"],
+                "body": {"type": op["reply"], "in_reply_to": op["msg_id"]}}
+
+    def promote_learners(self):
+        """As the leader, promotes learners waiting to become voters once
+        they're within max_learner_lag entries of us, one at a time."""
+        if self.state != "leader" or not self.promotions:
+            return None
+
+        now = self.clock()
+        for p in list(self.promotions):
+            deadline, msg = p
+            node = msg["body"]["node"]
+            if node not in self.learners:
+                self.promotions.remove(p)
+                self.net.reply(msg, {"type": "error", "code": 22,
+                                     "text": str(node) + " is not a learner"})
+            elif deadline <= now:
+                self.promotions.remove(p)
+                self.net.reply(msg, {"type": "error", "code": 11,
+                                     "text": str(node) + " is still catching up"})
+            elif self.log.size() - self._match_index[node] <= self.max_learner_lag \
+                    and not self.config_change_pending():
+                self.promotions.remove(p)
+                self.change_config(msg, self.voters() + [node],
+                                   [n for n in self.learners if n != node])
+                return True
+        if self.promotions:
+            self.timers.set("promote", min(p[0] for p in self.promotions))
+
+    def fail_promotions(self):
+        """We're no longer the leader; tell whoever's waiting on promotions."""
+        for deadline, msg in self.promotions:
+            self.net.reply(msg, {"type": "error", "code": 11, "text": "not a leader"})
+        self.promotions = []
+
+    def save_state(self):
+        """Persists our current term and vote, if we're durable."""
+        if self.data_dir:
+            write_durably(os.path.join(self.data_dir, "state.json"), json.dumps({
+                "term": self.current_term,
+                "voted_for": self.voted_for,
+                }).encode("utf-8"))
+
+    def save_snapshot(self):
+        """Persists our latest snapshot, if we're durable."""
+        if self.data_dir:
+            write_durably(os.path.join(self.data_dir, "snapshot.json"),
+                    codec.dumps(self.snapshot))
+
+    def reply_durably(self, msg, body):
+        """Replies to msg once everything we've appended is on disk."""
+        self.unsynced_replies.append((msg, body))
+
+    def sync(self):
+        """Makes this tick's log writes durable with a single sync, then sends
+        the replies that were waiting on them."""
+        self.log.sync()
+        if self.state == "leader" and \
+                self.match_quorum.update(self.node_id, self.log.size()):
+            # Our own entries count towards a quorum once they're durable
+            self.advance_commit_index()
+        replies = self.unsynced_replies
+        self.unsynced_replies = []
+        for msg, body in replies:
+            self.net.reply(msg, body)
+
+    def brpc(self, body, handler, timeout=None):
+        """Broadcast an RPC message to all other voters, and call handler with each response."""
+        for node in self.other_voters():
+            self.net.rpc(node, body, handler, timeout)
 
     def reset_election_deadline(self):
-        """Don't start an election for a little while."""
-        self.election_deadline = time.time() + (self.election_timeout * (random.random() + 1))
+        """Don't start an election for a little while. If our group prefers a
+        leader, it waits 1-1.5 election timeouts and everyone else 1.5-2.5,
+        so it usually wins; otherwise everyone waits 1-2."""
+        if self.preferred_leader is None:
+            factor = random.random() + 1
+        elif self.preferred_leader == self.node_id:
+            factor = random.random() / 2 + 1
+        else:
+            factor = random.random() + 1.5
+        self.election_deadline = self.clock() + self.election_timeout * factor
+        self.timers.set("election", self.election_deadline)
+
+    def set_election_timeout(self, timeout):
+        """Sets our election timeout, within bounds, and our heartbeat
+        interval to match."""
+        self.election_timeout = min(self.max_election_timeout,
+                                    max(self.min_election_timeout, timeout))
+        self.update_heartbeat_interval()
+
+    def update_heartbeat_interval(self):
+        """Heartbeats go at a quarter of the election timeout, so a follower
+        can miss a few before giving up on us. As the leader, we go by the
+        shortest timeout a voter might still be using: a longer one we've
+        sent doesn't count until the voter acknowledges an append carrying
+        it, and a voter we haven't heard from may have the shortest."""
+        timeout = self.election_timeout
+        if self.state == "leader":
+            for node in self.other_voters():
+                adopted = self.adopted_timeouts.get(node)
+                timeout = min(timeout, adopted[1] if adopted else self.min_election_timeout)
+        self.heartbeat_interval = timeout / 4
+
+    def sample_rtt(self, node, rtt):
+        """Folds an append's round trip to node into its smoothed RTT and
+        deviation, as TCP does, then retunes our timing to match."""
+        est = self.rtt.get(node)
+        if est is None:
+            self.rtt[node] = [rtt, rtt / 2]
+        else:
+            est[1] = 0.75 * est[1] + 0.25 * abs(est[0] - rtt)
+            est[0] = 0.875 * est[0] + 0.125 * rtt
+        self.adapt_timing()
+
+    def adapt_timing(self):
+        """As the leader, sets our election timeout to election_rtts RTT
+        timeouts (smoothed RTT plus four deviations) of our slowest voter,
+        within bounds. Followers adopt it from our appends, so failover time
+        tracks the real network rather than the worst case. We ignore changes
+        under 10%, so the timing doesn't jitter with every sample, and move
+        by at most max_timing_step at a time, so one slow sample can't leap
+        to the maximum. When the timeout grows we heartbeat right away, to
+        tell the followers."""
+        rtos = [srtt + 4 * dev for n, (srtt, dev) in self.rtt.items()
+                if n not in self.learners and n in self.node_ids]
+        if not rtos:
+            return None
+        current = self.election_timeout
+        target = min(self.max_election_timeout,
+                     max(self.min_election_timeout, self.election_rtts * max(rtos)))
+        target = min(current * self.max_timing_step,
+                     max(current / self.max_timing_step, target))
+        if 0.1 * current < abs(target - current):
+            debug("Election timeout now", target)
+            self.set_election_timeout(target)
+            if current < self.election_timeout:
+                self.heartbeat_requested = True
+            return True
 
     def reset_step_down_deadline(self):
         """Don't step down for a while."""
-        self.step_down_deadline = time.time() + self.election_timeout
+        self.step_down_deadline = self.clock() + self.election_timeout
+        self.timers.set("step_down", self.step_down_deadline)
+
+    def schedule_replication(self):
+        """If we're the leader, set the replication timer: soon if a follower
+        is missing entries, otherwise at the next heartbeat."""
+        if self.state != "leader":
+            self.timers.cancel("replicate")
+            return
+
+        size = self.log.size()
+        if self.heartbeat_requested or self.replication_requested:
+            interval = 0
+        elif any(ni <= size and len(self.in_flight[n]) < self.max_in_flight
+                 for n, ni in self.next_index.items()):
+            interval = self.min_replication_interval
+        elif self.shared_heartbeats:
+            # Our MultiRaft asks for heartbeats from every group at once;
+            # this is only a backstop, and gets a new leader going
+            interval = 2 * self.heartbeat_interval
+        else:
+            interval = self.heartbeat_interval
+        self.timers.set("replicate", self.last_replication + interval)
 
     def advance_term(self, term):
         """Advance our term to `term`, resetting who we voted for."""
@@ -275,6 +2272,14 @@ class RaftNode:
 
         self.current_term = term
         self.voted_for = None
+        self.save_state()
+
+    def heard_from_leader_recently(self):
+        """Leader stickiness: if we're the leader, or heard from one within the
+        minimum election timeout, we shouldn't help anyone depose them. This is
+        what makes leader leases safe."""
+        return self.state == "leader" or \
+            self.clock() < self.last_leader_contact + self.election_timeout
 
     def maybe_step_down(self, remote_term):
         """If remote_term is bigger than ours, advance our term and become a follower."""
@@ -283,8 +2288,61 @@ class RaftNode:
             self.advance_term(remote_term)
             self.become_follower()
 
-    def request_votes(self):
-        """Request that other nodes vote for us as a leader"""
+    def log_up_to_date(self, body):
+        """Is a candidate's log, as described by its vote request body, at
+        least as up to date as ours?"""
+        if body["last_log_term"] < self.log.last_term():
+            log("have log entries from term", self.log.last_term(),
+                "which is newer than remote term",
+                body["last_log_term"], "not granting vote",
+            )
+            return False
+        if body["last_log_term"] == self.log.last_term() \
+                and body["last_log_index"] < self.log.size():
+            log("Our logs are both at term", self.log.last_term(),
+                "but our log is", self.log.size(),
+                "and theirs is only", body["last_log_index"])
+            return False
+        return True
+
+    def request_pre_votes(self):
+        """Asks the other nodes whether they'd vote for us in the next term,
+        without anyone advancing their term, and only stands for election if
+        a majority would. A node that can't reach a majority, like one on the
+        wrong side of a partition, never bumps its term, so it can't depose a
+        healthy leader when it rejoins."""
+        votes = set([self.node_id])
+        term = self.current_term
+        self.counters["pre_votes"] += 1
+        self.reset_election_deadline()
+        debug("Requesting pre-votes for term", term + 1)
+
+        def handle(res):
+            body = res["body"]
+            self.maybe_step_down(body["term"])
+
+            if self.state in ("follower", "candidate") \
+                and self.current_term == term \
+                and body["vote_granted"]:
+
+                votes.add(res["src"])
+                if majority(len(self.voters())) <= len(votes):
+                    votes.clear()  # Only stand once per round
+                    self.become_candidate()
+
+        self.brpc({
+            "type": "request_vote",
+            "pre_vote": True,
+            "term": term + 1,
+            "candidate_id": self.node_id,
+            "last_log_index": self.log.size(),
+            "last_log_term": self.log.last_term(),
+            },
+            handle, self.vote_timeout)
+
+    def request_votes(self, transfer=False):
+        """Request that other nodes vote for us as a leader. If the leader is
+        handing leadership to us, we say so, so voters don't stick with it."""
 
         # We vote for ourself
         votes = set([self.node_id])
@@ -302,43 +2360,57 @@ class RaftNode:
 
                 # We have a vote for our candidacy
                 votes.add(res["src"])
-                log("Have votes:", pformat(votes, width=128))
+                debug("Have votes:", Pretty(votes))
 
-                if majority(len(self.node_ids)) <= len(votes):
+                if majority(len(self.voters())) <= len(votes):
                     # We have a majority of votes from this term
                     self.become_leader()
 
         # Broadcast vote request
-        self.brpc({
+        body = {
             "type": "request_vote",
             "term": self.current_term,
             "candidate_id": self.node_id,
             "last_log_index": self.log.size(),
-            "last_log_term": self.log.last()["term"],
-            },
-            handle)
+            "last_log_term": self.log.last_term(),
+            }
+        if transfer:
+            body["transfer"] = True
+        self.brpc(body, handle, self.vote_timeout)
 
     # Role transitions
 
     def become_follower(self):
         """Become a follower"""
+        if self.state == "leader":
+            self.counters["step_downs"] += 1
         self.state = "follower"
         self.next_index = None
         self._match_index = None
+        self.match_quorum = None
+        self.acked_at = None
+        self.in_flight = None
         self.leader = None
+        self.traces = {}
+        self.appended_ops.clear()
+        self.commit_times.clear()
+        self.fail_pending_reads()
+        self.fail_promotions()
         self.reset_election_deadline()
         log("Became follower for term", self.current_term)
 
-    def become_candidate(self):
+    def become_candidate(self, transfer=False):
         """Become a candidate, advance our term, and request votes."""
         self.state = "candidate"
+        self.counters["elections"] += 1
         self.advance_term(self.current_term + 1)
         self.voted_for = self.node_id
+        self.save_state()
         self.leader = None
         self.reset_step_down_deadline()
         log("Became candidate for term ", self.current_term)
         self.reset_election_deadline()
-        self.request_votes()
+        self.request_votes(transfer)
 
     def become_leader(self):
         """Become a leader"""
@@ -351,32 +2423,299 @@ class RaftNode:
         # We'll start by trying to replicate our most recent entry
         self.next_index = {n: self.log.size() + 1 for n in self.other_nodes()}
         self._match_index = {n: 0 for n in self.other_nodes()}
+        self.match_quorum = QuorumTracker(self.match_index())
+        self.acked_at = {n: 0 for n in self.other_nodes()}
+        self.in_flight = {n: collections.deque() for n in self.other_nodes()}
+        self.adopted_timeouts = {}
+        self.update_heartbeat_interval()
+        self.next_rebalance = self.clock() + self.election_timeout
         self.reset_step_down_deadline()
         log("Became leader for term", self.current_term)
 
+    # Reads
+
+    def quorum_ack_time(self):
+        """The latest time t such that a majority of the cluster, counting us,
+        has acknowledged messages we sent at or after t."""
+        times = [self.acked_at[n] for n in self.other_voters()]
+        times.append(self.clock())
+        return median(times)
+
+    def has_lease(self):
+        """Can we be sure nobody else has been elected leader since our last
+        quorum ack? Assumes clocks drift less than our lease margin."""
+        if self.transfer_target is not None:
+            # Our successor may be elected without waiting our lease out
+            return False
+        acked = self.quorum_ack_time()
+        if acked <= self.transfer_aborted:
+            # A handoff we gave up on may yet have elected its target; only
+            # acks for what we've sent since can tell us it didn't
+            return False
+        return self.clock() < acked + self.lease_duration
+
+    def read_without_log(self, op):
+        """As the leader, tries to serve a read from the state machine without
+        appending it to the log: right away if we hold a lease, or once a round
+        of heartbeats confirms we're still leader. Returns True if we took the
+        read; False means it has to go through the log."""
+        if self.read_mode == "log" or self.commit_index < self.log.start \
+                or self.log.term(self.commit_index) != self.current_term:
+            # Until we've committed something this term, we don't know how far
+            # the commit index really goes.
+            return False
+
+        if self.read_mode == "lease" and self.last_applied == self.commit_index \
+                and self.has_lease():
+            res = self.state_machine.apply(op)
+            self.net.send(res["dest"], res["body"])
+            self.counters["lease_reads"] += 1
+        else:
+            self.pending_reads.append([self.clock(), self.commit_index, op])
+            self.heartbeat_requested = True
+        return True
+
+    def serve_reads(self):
+        """Answers pending reads whose read index we've applied, and which we
+        know we were still the leader for when they arrived."""
+        if not self.pending_reads:
+            return
+
+        acked = self.quorum_ack_time()
+        ready = [r for r in self.pending_reads
+                 if r[0] <= acked and r[1] <= self.last_applied]
+        if ready:
+            self.pending_reads = [r for r in self.pending_reads
+                                  if not (r[0] <= acked and r[1] <= self.last_applied)]
+            self.net.send_batch([self.state_machine.apply(r[2]) for r in ready])
+            now = self.clock()
+            for r in ready:
+                self.latencies["read_index"].record(now - r[0])
+            return True
+
+    def fail_pending_reads(self):
+        """We're no longer the leader; tell clients waiting on reads."""
+        for r in self.pending_reads:
+            self.net.send(r[2]["client"], {
+                "type": "error",
+                "in_reply_to": r[2]["msg_id"],
+                "code": 11,
+                "text": "not a leader",
+                })
+        self.pending_reads = []
+
+    def holding_client_msgs(self):
+        """While leadership changes hands, we hold on to client requests until
+        we know who has it, rather than growing the log the new leader has to
+        catch up on, or turning clients away."""
+        if self.transfer_target is None:
+            return False
+        if self.state == "leader":
+            return self.transfer_target != self.node_id
+        return not self.leader
+
+    def dispatch_client_msgs(self):
+        """Deals with the client requests that arrived this tick all at once.
+        As the leader, we append them to the log as a single batch and start
+        replicating it right away; otherwise we forward them to the leader in
+        one envelope."""
+        msgs = self.client_msgs
+        if not msgs:
+            return None
+        if self.holding_client_msgs():
+            return None
+        self.client_msgs = []
+
+        if self.state == "leader":
+            now = self.clock()
+            index = self.log.size()
+            entries = []
+            for m in msgs:
+                op = m["body"]
+                session = (op["client"], op["msg_id"])
+                if session in self.appended_ops:
+                    # A retry of an op that's already on its way; its reply
+                    # will answer both
+                    self.counters["duplicates_merged"] += 1
+                    continue
+                index += 1
+                self.appended_ops[session] = index
+                self.traces[index] = (m.get("received", now), now)
+                entries.append({"term": self.current_term, "op": op})
+            self.log.append(entries)
+            self.replication_requested = True
+            debug("Appended", len(entries), "client ops")
+        elif self.leader:
+            # We time proxying here, by our own clock: how long we held each
+            # op. The leader stamps them again when they arrive, since its
+            # clock needn't agree with ours.
+            now = self.clock()
+            for m in msgs:
+                self.latencies["proxy"].record(now - m["received"])
+            self.net.send(self.leader, {"type": "forward", "msgs": [
+                {"src": m["src"], "dest": m["dest"], "body": m["body"]} for m in msgs]})
+        else:
+            for m in msgs:
+                self.net.reply(m, {
+                    "type": "error",
+                    "code": 11,
+                    "text": "not a leader"
+                    })
+        return True
+
     # Actions for all  nodes
 
     def advance_state_machine(self):
-        """If we have unapplied committed entries in the log, apply one to the state machine."""
+        """If we have unapplied committed entries in the log, apply all of them to the state machine."""
         if self.last_applied < self.commit_index:
-            # Advance the applied index and apply that op
-            self.last_applied += 1
-            res = self.state_machine.apply(self.log.get(self.last_applied)["op"])
+            # Apply every committed op in one go, and advance the applied index
+            first = self.last_applied + 1
+            ops = self.log.slice(first, self.commit_index).ops()
+            if any(op["type"] == "config" for op in ops):
+                responses = [self.apply_config(op) if op["type"] == "config"
+                             else self.state_machine.apply(op) for op in ops]
+            else:
+                responses = self.state_machine.apply_batch(ops)
+            self.last_applied = self.commit_index
             if self.state == "leader":
-                # We were the leader, let's respond to the client.
-                self.net.send(res["dest"], res["body"])
+                # We were the leader, let's respond to the clients.
+                applied = self.clock()
+                self.net.send_batch(responses)
+                pending = self.appended_ops
+                while pending and next(iter(pending.values())) <= self.last_applied:
+                    pending.popitem(last=False)
+                if self.traces:
+                    self.trace_ops(first, self.last_applied, applied)
+            self.commit_times.clear()
+
+            # We did something!
+            return True
 
-        # We did something!
+    def trace_ops(self, first, last, applied):
+        """Records how long each client op we just applied and answered, from
+        first to last, spent in each phase: waiting to be appended, to commit,
+        to be applied, and to have its reply sent."""
+        replied = self.clock()
+        commits = self.commit_times
+        for i in range(first, last + 1):
+            trace = self.traces.pop(i, None)
+            if trace is None:
+                continue
+            while commits and commits[0][0] < i:
+                commits.popleft()
+            received, appended = trace
+            committed = commits[0][1] if commits else applied
+            self.latencies["append"].record(appended - received)
+            self.latencies["commit"].record(committed - appended)
+            self.latencies["apply"].record(applied - committed)
+            self.latencies["reply"].record(replied - applied)
+            self.latencies["total"].record(replied - received)
+
+    def stats(self):
+        """Everything we measure about ourselves, as JSON-friendly dicts."""
+        return {
+            "node": self.node_id,
+            "state": self.state,
+            "term": self.current_term,
+            "leader": self.leader,
+            "transfer_target": self.transfer_target,
+            "timing": {
+                "election_timeout": self.election_timeout,
+                "heartbeat_interval": self.heartbeat_interval,
+                "rtt": dict((n, {"srtt": srtt, "dev": dev})
+                            for n, (srtt, dev) in self.rtt.items()),
+                },
+            "voters": self.voters(),
+            "learners": sorted(self.learners),
+            "commit_index": self.commit_index,
+            "last_applied": self.last_applied,
+            "log": {"start": self.log.start, "size": self.log.size()},
+            "counters": dict(self.counters),
+            "sessions": {
+                "size": len(self.state_machine.sessions),
+                "duplicates_applied": self.state_machine.duplicates,
+                },
+            "net": {
+                "msgs_in": self.net.msgs_in,
+                "msgs_out": self.net.msgs_out,
+                "bytes_in": self.net.transport.bytes_in,
+                "bytes_out": self.net.transport.bytes_out,
+                "callbacks": len(self.net.callbacks),
+                "expired": self.net.expired,
+                },
+            "latency": dict((phase, h.summary()) for phase, h in self.latencies.items()),
+            }
+
+    def dump_stats(self):
+        """Appends our stats to the stats file, as a line of JSON, if one is
+        configured and it's time."""
+        if not self.stats_file:
+            return None
+        now = self.clock()
+        if now < self.next_stats_dump:
+            return None
+        self.next_stats_dump = now + self.stats_interval
+        self.timers.set("stats", self.next_stats_dump)
+        stats = self.stats()
+        stats["time"] = now
+        with open(self.stats_file, "ab") as f:
+            f.write(self.net.codec.dumps(stats) + b"\n")
         return True
 
+    def compact_log(self):
+        """If we've applied enough entries since the start of the log, snapshot
+        the state machine and discard the log up to the last applied entry."""
+        if self.snapshot_interval <= self.last_applied - self.log.start:
+            self.snapshot = {
+                "index": self.last_applied,
+                "term": self.log.term(self.last_applied),
+                "state": self.state_machine.snapshot(),
+                "config": [self.voters(), sorted(self.learners)],
+                }
+            self.save_snapshot()
+            self.log.compact(self.last_applied)
+            debug("Compacted log up to", self.last_applied)
+            return True
+
+    def install_snapshot(self, index, term, state, config=None):
+        """Replaces our state machine, and configuration if given, with a
+        leader's snapshot, keeping any log entries that follow it if our log
+        agrees with the snapshot."""
+        try:
+            ours = self.log.term(index)
+        except IndexError:
+            ours = None
+
+        self.state_machine.restore(state)
+        self.snapshot = {"index": index, "term": term, "state": state}
+        if config is not None:
+            self.snapshot["config"] = config
+            self.set_config(*config)
+        self.save_snapshot()
+
+        if ours == term:
+            self.log.compact(index)
+        else:
+            self.log.reset(index, term)
+
+        self.commit_index = max(self.commit_index, index)
+        self.last_applied = index
+        log("Installed snapshot up to", index)
+
     # Actions for followers/candidates
 
     def election(self):
         """If it's been long enough, trigger a leader election."""
-        if self.election_deadline < time.time():
-            if self.state == "follower" or self.state == "candidate":
+        if self.election_deadline <= self.clock():
+            if self.node_id not in self.voters():
+                # Learners never stand for election
+                self.reset_election_deadline()
+            elif self.state == "follower" or self.state == "candidate":
                 # Let's go!
-                self.become_candidate()
+                if self.pre_vote:
+                    self.request_pre_votes()
+                else:
+                    self.become_candidate()
             else:
                 # We're a leader, or initializing; sleep again
                 self.reset_election_deadline()
@@ -386,75 +2725,268 @@ class RaftNode:
 
     def step_down_on_timeout(self):
         """If we haven't received any acks for a while, step down."""
-        if self.state == "leader" and self.step_down_deadline < time.time():
+        if self.state == "leader" and self.step_down_deadline <= self.clock():
             log("Stepping down: haven't received any acks recently")
             self.become_follower()
             return True
 
+    def transfer_leadership(self, target=None):
+        """Starts handing leadership to target, or if None, to whichever
+        follower has the most of our log. Until the handoff, we take no new
+        ops, so the target can catch up; once it has, we tell it to stand for
+        election right away, rather than waiting out an election timeout.
+        Returns the target, or None if we're not a leader that can."""
+        if self.state != "leader" or self.transfer_target is not None \
+                or not self.next_index:
+            return None
+        voters = self.other_voters()
+        if target is None and voters:
+            target = max(voters, key=lambda n: self._match_index[n])
+        elif target not in voters:
+            return None
+
+        log("Transferring leadership to", target)
+        self.counters["transfers"] += 1
+        self.transfer_target = target
+        self.transfer_deadline = self.clock() + self.election_timeout
+        self.timeout_now_sent = False
+        self.timers.set("transfer", self.transfer_deadline)
+        self.replication_requested = True
+        return target
+
+    def advance_transfer(self):
+        """Moves a leadership handoff along: tells the target to stand once it
+        has all our entries, and finishes once someone's leader again, or
+        gives up if that takes longer than an election timeout."""
+        if self.transfer_target is None:
+            return None
+
+        if self.state == "leader" and self.transfer_target == self.node_id:
+            log("Leadership transferred to us")
+            return self.end_transfer()
+        if self.state != "leader" and self.leader:
+            return self.end_transfer()
+        if self.transfer_deadline <= self.clock():
+            log("Leadership transfer to", self.transfer_target, "timed out")
+            self.counters["transfers_failed"] += 1
+            if self.timeout_now_sent:
+                self.transfer_aborted = self.clock()
+            self.next_rebalance = self.clock() + 10 * self.election_timeout
+            return self.end_transfer()
+
+        target = self.transfer_target
+        if self.state == "leader" and not self.timeout_now_sent \
+                and self._match_index[target] == self.log.size():
+            self.timeout_now_sent = True
+            self.net.send(target, {"type": "timeout_now", "term": self.current_term})
+            return True
+
+    def end_transfer(self):
+        """We're done handing off leadership, one way or another."""
+        self.transfer_target = None
+        self.timeout_now_sent = False
+        self.timers.cancel("transfer")
+        return True
+
+    def rebalance(self):
+        """If our group prefers some other node as its leader, and that node
+        is caught up and responsive, hands leadership back to it. This is how
+        leaders spread out across nodes again after a failover."""
+        p = self.preferred_leader
+        if self.state == "leader" and p in self.other_voters() \
+                and self.transfer_target is None \
+                and self.next_rebalance < self.clock() \
+                and self._match_index[p] == self.log.size() \
+                and self.clock() < self.acked_at[p] + self.election_timeout:
+            return self.transfer_leadership(p) is not None
+
     def advance_commit_index(self):
-        """If we're the leader, advance our commit index based on what other nodes match us."""
+        """If we're the leader, advance our commit index based on what other
+        nodes match us. Called whenever a match index, ours included, changes."""
         if self.state == "leader":
-            n = median(self.match_index().values())
-            if self.commit_index < n and self.log.get(n)["term"] == self.current_term:
-                log("Commit index now", n)
+            n = self.match_quorum.quorum_value()
+            if self.commit_index < n and self.log.term(n) == self.current_term:
+                debug("Commit index now", n)
                 self.commit_index = n
+                self.commit_times.append((n, self.clock()))
                 return True
 
     def replicate_log(self):
         """If we're the leader, replicate unacknowledged log entries to followers. Also serves as a heartbeat."""
 
         # How long has it been since we replicated?
-        elapsed_time = time.time() - self.last_replication
+        elapsed_time = self.clock() - self.last_replication
         # We'll set this to true if we replicate to anyone
         replicated = False
-        # We'll need this to make sure we process responses in *this* term
-        term = self.current_term
 
-        if self.state == "leader" and self.min_replication_interval < elapsed_time:
+        if self.state == "leader" and \
+                (self.min_replication_interval < elapsed_time or self.heartbeat_requested
+                 or self.replication_requested):
             # We're a leader, and enough time elapsed
+            heartbeat = self.heartbeat_requested or self.heartbeat_interval < elapsed_time
             for node in self.other_nodes():
-                # What entries should we send this node?
-                ni = self.next_index[node]
-                entries = self.log.from_index(ni)
-                if 0 < len(entries) or self.heartbeat_interval < elapsed_time:
-                    log("replicating " + str(ni) + "+ to", node)
-
-                    # "closure"
-                    _ni = ni
-                    _entries = list(entries)
-                    _node = node
-
-                    def handler(res):
-                        body = res["body"]
-                        self.maybe_step_down(body["term"])
-                        if self.state == "leader" and term == self.current_term:
-                            self.reset_step_down_deadline()
-                            if body["success"]:
-                                self.next_index[_node] = \
-                                    max(self.next_index[_node], _ni + len(_entries))
-                                self._match_index[_node] = \
-                                    max(self._match_index[_node], _ni - 1 + len(_entries))
-                                log("node", _node, "# entries", len(_entries), "ni", ni)
-                                log("next index:", pformat(self.next_index))
-                            else:
-                                self.next_index[_node] -= 1
-
-                    self.net.rpc(node, {
-                        "type": "append_entries",
-                        "term": self.current_term,
-                        "leader_id": self.node_id,
-                        "prev_log_index": ni - 1,
-                        "prev_log_term": self.log.get(ni - 1)["term"],
-                        "entries": entries,
-                        "leader_commit": self.commit_index,
-                        }, handler)
+                if self.replicate_to(node, heartbeat):
                     replicated = True
+            self.replication_requested = False
 
         if replicated:
             # We did something!
-            self.last_replication = time.time()
+            self.last_replication = self.clock()
+            self.heartbeat_requested = False
             return True
 
+    def replicate_to(self, node, heartbeat):
+        """Sends a follower its next batch of entries, if its pipeline has
+        room, or an empty append if a heartbeat is due. We advance next_index
+        as soon as we send, so the next call picks up where this one left off
+        without waiting for the follower to respond."""
+        now = self.clock()
+        in_flight = self.in_flight[node]
+        ni = self.next_index[node]
+        if ni <= self.log.start and self.snapshot is None:
+            # Nothing's been compacted; every log starts with the same entry
+            ni = self.next_index[node] = self.log.start + 1
+        if ni <= self.log.start:
+            # Those entries are gone; send a snapshot instead
+            if not any(r[2] is None for r in in_flight):
+                self.send_snapshot(node)
+                return True
+            return None
+
+        entries = self.log.slice(ni, ni - 1)
+        if len(in_flight) < self.max_in_flight:
+            entries = self.entries_to_send(ni)
+        if not (entries or heartbeat):
+            return None
+
+        debug("replicating " + str(ni) + "+ to", node)
+        # In-flight records are [sent time, next index, # entries]
+        record = [now, ni, len(entries)]
+        in_flight.append(record)
+        self.next_index[node] = ni + len(entries)
+        # We'll need this to make sure we process responses in *this* term
+        term = self.current_term
+        timeout = self.election_timeout
+
+        def handler(res):
+            body = res["body"]
+            self.maybe_step_down(body["term"])
+            if self.state == "leader" and term == self.current_term \
+                    and node in self.next_index:
+                if node not in self.learners:
+                    # Only voters can keep us leader
+                    self.reset_step_down_deadline()
+                self.acked_at[node] = max(self.acked_at[node], record[0])
+                adopted = self.adopted_timeouts.get(node)
+                if adopted is None or adopted[0] <= record[0]:
+                    # They've taken on the election timeout this carried
+                    self.adopted_timeouts[node] = (record[0], timeout)
+                    self.update_heartbeat_interval()
+                self.sample_rtt(node, self.clock() - record[0])
+                current = any(r is record for r in in_flight)
+                if current:
+                    in_flight.remove(record)
+
+                if body["success"]:
+                    self.next_index[node] = \
+                        max(self.next_index[node], ni + len(entries))
+                    self.set_match_index(node, ni - 1 + len(entries))
+                    debug("node", node, "# entries", len(entries), "ni", ni)
+                elif current:
+                    # Whatever else is in flight will fail too; back up and
+                    # try again from where the follower's log might agree.
+                    in_flight.clear()
+                    self.next_index[node] = \
+                        max(self._match_index[node] + 1, self.conflict_next_index(ni, body))
+
+        self.net.rpc(node, {
+            "type": "append_entries",
+            "term": self.current_term,
+            "leader_id": self.node_id,
+            "prev_log_index": ni - 1,
+            "prev_log_term": self.log.term(ni - 1),
+            "entries": entries.to_dicts(),
+            "leader_commit": self.commit_index,
+            "election_timeout": timeout,
+            }, handler, self.append_timeout, self.append_timed_out(node, record, term))
+        return True
+
+    def append_timed_out(self, node, record, term):
+        """Returns a timeout handler for an append (or snapshot) to node: if
+        it's still in flight, something we sent got lost, so start over from
+        what the follower is known to have."""
+        def timed_out():
+            in_flight = self.in_flight and self.in_flight.get(node)
+            if self.state == "leader" and term == self.current_term \
+                    and in_flight and any(r is record for r in in_flight):
+                log("append to", node, "timed out; resending from", self._match_index[node] + 1,
+                    "(" + str(len(self.net.callbacks)), "RPCs outstanding)")
+                in_flight.clear()
+                self.next_index[node] = self._match_index[node] + 1
+                self.heartbeat_requested = True
+        return timed_out
+
+    def conflict_next_index(self, ni, body):
+        """A follower rejected an append starting at ni; where should we try
+        next? If it told us the term it has there, skip past the rest of our
+        entries for that term, or to where its term begins if we have none.
+        Otherwise skip to the end of its log, or, failing any hints, back up
+        one entry."""
+        if "conflict_index" not in body:
+            return ni - 1
+
+        if body.get("conflict_term") is not None:
+            last = self.log.last_index_of_term(body["conflict_term"])
+            if last is not None:
+                return min(ni - 1, last + 1)
+        return min(ni - 1, body["conflict_index"])
+
+    def entries_to_send(self, ni):
+        """Entries from index ni on, up to our per-append count and
+        (approximate) byte limits; always at least one, if there are any."""
+        entries = self.log.slice(ni, ni + self.max_append_entries - 1)
+        size = 0
+        for i in range(len(entries)):
+            size += self.log.op_size(ni + i)
+            if self.max_append_bytes < size and 0 < i:
+                return entries[:i]
+        return entries
+
+    def send_snapshot(self, node):
+        """Sends our latest snapshot to a follower whose next entry we've
+        compacted away. We optimistically assume it'll arrive; if it doesn't,
+        the follower will reject the next append and we'll come back here."""
+        snapshot = self.snapshot
+        term = self.current_term
+        in_flight = self.in_flight[node]
+        # A snapshot's in-flight record has no entry count
+        record = [self.clock(), snapshot["index"] + 1, None]
+        in_flight.append(record)
+        self.next_index[node] = snapshot["index"] + 1
+        log("sending snapshot up to", snapshot["index"], "to", node)
+
+        def handler(res):
+            body = res["body"]
+            self.maybe_step_down(body["term"])
+            if self.state == "leader" and term == self.current_term \
+                    and node in self.next_index:
+                if node not in self.learners:
+                    self.reset_step_down_deadline()
+                self.acked_at[node] = max(self.acked_at[node], record[0])
+                if any(r is record for r in in_flight):
+                    in_flight.remove(record)
+                self.set_match_index(node, snapshot["index"])
+
+        self.net.rpc(node, {
+            "type": "install_snapshot",
+            "term": self.current_term,
+            "leader_id": self.node_id,
+            "last_included_index": snapshot["index"],
+            "last_included_term": snapshot["term"],
+            "data": snapshot["state"],
+            "config": snapshot.get("config"),
+            }, handler, self.append_timeout, self.append_timed_out(node, record, term))
+
     # Message handlers
 
     def setup_handlers(self):
@@ -466,11 +2998,7 @@ class RaftNode:
                 raise RuntimeError("Can't init twice!")
 
             body = msg["body"]
-            self.set_node_id(body["node_id"])
-            self.node_ids = body["node_ids"]
-
-            self.become_follower()
-
+            self.init(body["node_id"], body["node_ids"], body.get("learners"))
             log("I am:", self.node_id)
             self.net.reply(msg, {"type": "raft_init_ok"})
 
@@ -479,6 +3007,40 @@ class RaftNode:
         # When a node requests our vote...
         def request_vote(msg):
             body = msg["body"]
+            if body["candidate_id"] not in self.voters():
+                log("candidate", body["candidate_id"], "isn't a voter; not granting vote")
+                self.net.reply(msg, {
+                    "type": "request_vote_res",
+                    "term": self.current_term,
+                    "vote_granted": False,
+                    })
+                return None
+
+            if body.get("pre_vote"):
+                # Would we vote for them in the term they propose? Answering
+                # changes nothing, not even our term.
+                grant = self.current_term < body["term"] \
+                    and not self.heard_from_leader_recently() \
+                    and self.log_up_to_date(body)
+                debug("Pre-vote for", msg["src"], "in term", body["term"], grant)
+                self.net.reply(msg, {
+                    "type": "request_vote_res",
+                    "term": self.current_term,
+                    "vote_granted": grant,
+                    })
+                return None
+
+            if self.current_term < body["term"] and not body.get("transfer") \
+                    and self.heard_from_leader_recently():
+                # Don't let a candidate depose a leader we've just heard from
+                log("heard from leader recently; ignoring vote request from", msg["src"])
+                self.net.reply(msg, {
+                    "type": "request_vote_res",
+                    "term": self.current_term,
+                    "vote_granted": False,
+                    })
+                return None
+
             self.maybe_step_down(body["term"])
             grant = False
 
@@ -487,20 +3049,13 @@ class RaftNode:
                     self.current_term, "not granting vote")
             elif self.voted_for is not None:
                 log("already voted for", self.voted_for, "not granting vote")
-            elif body["last_log_term"] < self.log.last()["term"]:
-                log("have log entries from term", self.log.last()["term"],
-                    "which is newer than remote term",
-                    body["last_log_term"], "not granting vote",
-                )
-            elif body["last_log_term"] == self.log.last()["term"] \
-                and body["last_log_index"] < self.log.size():
-                log("Our logs are both at term", self.log.last()["term"],
-                    "but our log is", self.log.size(),
-                    "and theirs is only", body["last_log_index"])
+            elif not self.log_up_to_date(body):
+                pass
             else:
                 log("Granting vote to", msg["src"])
                 grant = True
                 self.voted_for = body["candidate_id"]
+                self.save_state()
                 self.reset_election_deadline()
 
             self.net.reply(msg, {
@@ -527,51 +3082,115 @@ class RaftNode:
                 self.net.reply(msg, res)
                 return None
 
-            # This leader is valid; remember them and don't try to run our own
-            # election for a bit
+            # This leader is valid; remember them, take on the election
+            # timeout they've measured, and don't try to run our own election
+            # for a bit
             self.leader = body["leader_id"]
+            self.last_leader_contact = self.clock()
+            if "election_timeout" in body:
+                self.set_election_timeout(body["election_timeout"])
             self.reset_election_deadline()
 
             # Check previous entry to see if it matches
-            if body["prev_log_index"] <= 0:
+            prev_log_index = body["prev_log_index"]
+            prev_log_term = body["prev_log_term"]
+            entries = body["entries"]
+            if prev_log_index <= 0:
                 raise RuntimeError("Out of bounds previous log index" + \
-                        str(body["prev_log_index"]))
+                        str(prev_log_index))
+
+            if prev_log_index < self.log.start:
+                # We've compacted past the previous entry. Everything up to our
+                # snapshot is committed, so it matches the leader; skip ahead.
+                entries = entries[self.log.start - prev_log_index:]
+                prev_log_index = self.log.start
+                prev_log_term = self.log.term(prev_log_index)
 
             try:
-                e = self.log.get(body["prev_log_index"])
+                ours = self.log.term(prev_log_index)
             except IndexError:
-                e = None
-
-            if (not e) or e["term"] != body["prev_log_term"]:
-                # We disagree on the previous term
+                ours = None
+
+            if ours != prev_log_term:
+                # We disagree on the previous term. Hint at where our logs
+                # might agree, so the leader can skip straight there: the
+                # start of our conflicting term, or the end of our log.
+                if ours is not None:
+                    res["conflict_term"] = ours
+                    res["conflict_index"] = self.log.first_index_of_term(ours)
+                else:
+                    res["conflict_index"] = self.log.size() + 1
                 self.net.reply(msg, res)
                 return None
 
-            # We agree on the previous log term; truncate and append
-            self.log.truncate(body["prev_log_index"])
-            self.log.append(body["entries"])
-
-            # Advance commit pointer
+            # We agree on the previous log term. Skip entries we already have,
+            # and only truncate if we find one that conflicts: appends can
+            # arrive late or twice, and mustn't undo newer ones.
+            for i, e in enumerate(entries):
+                index = prev_log_index + 1 + i
+                if self.log.size() < index:
+                    self.log.append(entries[i:])
+                    break
+                if self.log.term(index) != e["term"]:
+                    self.log.truncate(index - 1)
+                    self.log.append(entries[i:])
+                    break
+
+            # Advance commit pointer, as far as this append vouches for
             if self.commit_index < body["leader_commit"]:
-                self.commit_index = min(body["leader_commit"], self.log.size())
+                self.commit_index = max(self.commit_index,
+                        min(body["leader_commit"], prev_log_index + len(entries)))
 
-            # Acknowledge
+            # Acknowledge, once the new entries are durable
             res["success"] = True
-            self.net.reply(msg, res)
+            self.reply_durably(msg, res)
 
         self.net.on("append_entries", append_entries)
 
+        # When a leader sends us a snapshot of entries it no longer has
+        def install_snapshot(msg):
+            body = msg["body"]
+            self.maybe_step_down(body["term"])
+
+            if self.current_term <= body["term"]:
+                self.leader = body["leader_id"]
+                self.last_leader_contact = self.clock()
+                self.reset_election_deadline()
+                if self.commit_index < body["last_included_index"]:
+                    self.install_snapshot(body["last_included_index"],
+                            body["last_included_term"],
+                            body["data"], body.get("config"))
+
+            self.net.reply(msg, {
+                "type": "install_snapshot_res",
+                "term": self.current_term,
+                })
+
+        self.net.on("install_snapshot", install_snapshot)
+
         # Handle client KV requests
         def kv_req(msg):
-            if self.state == "leader":
-                # Record who we should tell about the completion of this op
-                op = msg["body"]
-                op["client"] = msg["src"]
-                self.log.append([{"term": self.current_term, "op": op}])
-            elif self.leader:
-                # We're not the leader, but we can proxy to one
-                msg["dest"] = self.leader
-                self.net.send_msg(msg)
+            msg["received"] = self.clock()
+            # Record who we should tell about the completion of this op,
+            # whoever ends up appending it
+            op = msg["body"]
+            op["client"] = msg["src"]
+            problem = op_problem(op)
+            if problem:
+                self.net.reply(msg, {"type": "error", "code": 12, "text": problem})
+            elif not self.state_machine.read_only(op) and self.state_machine.cached(op):
+                # A retry of an op we've applied already; any replica can
+                # answer it with the response it got the first time
+                self.counters["duplicates_cached"] += 1
+                self.net.send(msg["src"], self.state_machine.cached(op))
+            elif self.state == "leader":
+                if self.state_machine.read_only(op) and self.read_without_log(op):
+                    return None
+                self.client_msgs.append(msg)
+            elif self.leader or self.transfer_target is not None:
+                # We're not the leader, but we can proxy to one, or will once
+                # leadership has changed hands
+                self.client_msgs.append(msg)
             else:
                 self.net.reply(msg, {
                     "type": "error",
@@ -582,26 +3201,256 @@ class RaftNode:
         self.net.on("read", kv_req)
         self.net.on("write", kv_req)
         self.net.on("cas", kv_req)
+        self.net.on("txn", kv_req)
 
-    def main(self):
-        """Mainloop"""
-        log("Online.")
+        def forward(msg):
+            # Client requests a follower gathered up for us, as the leader
+            for m in msg["body"]["msgs"]:
+                kv_req(m)
 
-        while True:
-            try:
-                self.net.process_msg() \
-                    or self.step_down_on_timeout() \
-                    or self.replicate_log() \
-                    or self.election() \
-                    or self.advance_commit_index() \
-                    or self.advance_state_machine() \
-                    or time.sleep(0.001)
+        self.net.on("forward", forward)
 
-            except KeyboardInterrupt:
-                log("Aborted by interrupt!")
-                break
-            except:
-                log("Error!", traceback.format_exc())
+        def stats(msg):
+            self.net.reply(msg, {"type": "stats_ok", "stats": self.stats()})
+
+        self.net.on("stats", stats)
+
+        def profile(msg):
+            self.net.reply(msg, start_profile(msg["body"]))
+
+        self.net.on("profile", profile)
+
+        def transfer_leadership(msg):
+            # An operator wants us to hand off leadership, say before a restart
+            target = self.transfer_leadership(msg["body"].get("to"))
+            if target is None:
+                self.net.reply(msg, {
+                    "type": "error",
+                    "code": 11,
+                    "text": "not a leader, or already transferring"
+                    })
+            else:
+                self.net.reply(msg, {"type": "transfer_leadership_ok", "to": target})
+
+        self.net.on("transfer_leadership", transfer_leadership)
+
+        def timeout_now(msg):
+            # Our leader has caught us up and is handing leadership to us
+            if msg["body"]["term"] == self.current_term and self.state == "follower":
+                log("Leader", msg["src"], "is handing leadership to us")
+                self.transfer_target = self.node_id
+                self.transfer_deadline = self.clock() + self.election_timeout
+                self.timers.set("transfer", self.transfer_deadline)
+                self.become_candidate(transfer=True)
 
+        self.net.on("timeout_now", timeout_now)
+
+        # Membership changes, which only the leader can make
+        def membership(msg):
+            body = msg["body"]
+            node = body.get("node")
+            voters = self.voters()
+            learners = [n for n in self.node_ids if n in self.learners]
+            error = None
+            if self.state != "leader":
+                error = (11, "not a leader")
+            elif body["type"] == "promote_learner":
+                if node not in self.learners:
+                    error = (22, str(node) + " is not a learner")
+                else:
+                    # Wait for it to catch up
+                    self.promotions.append([self.clock() + self.promote_timeout, msg])
+                    return None
+            elif self.config_change_pending():
+                error = (11, "another configuration change is in progress")
+            elif body["type"] == "add_learner":
+                if node in self.node_ids:
+                    error = (22, str(node) + " is already a member")
+                else:
+                    self.change_config(msg, voters, learners + [node])
+            elif node == self.node_id:
+                error = (22, "transfer leadership away before removing the leader")
+            elif node not in self.node_ids:
+                error = (22, str(node) + " is not a member")
+            else:
+                self.change_config(msg, [n for n in voters if n != node],
+                                   [n for n in learners if n != node])
+            if error:
+                self.net.reply(msg, {"type": "error", "code": error[0], "text": error[1]})
+
+        self.net.on("add_learner", membership)
+        self.net.on("promote_learner", membership)
+        self.net.on("remove_node", membership)
+
+    def tick(self):
+        """Performs every action that's due, after a batch of messages or a timer."""
+        self.timers.pop_due(self.clock())
+        self.net.expire_callbacks(self.clock())
+        self.dispatch_client_msgs()
+        self.sync()
+        self.step_down_on_timeout()
+        self.rebalance()
+        self.advance_transfer()
+        self.promote_learners()
+        self.replicate_log()
+        self.election()
+        self.advance_state_machine()
+        self.serve_reads()
+        self.compact_log()
+        self.dump_stats()
+        self.schedule_replication()
+
+    def wait_time(self):
+        """How long can we block waiting for input before there's more to do?
+        None means until a message arrives."""
+        if self.last_applied < self.commit_index:
+            # Still entries to apply; don't sleep
+            return 0
+
+        deadlines = [d for d in (self.timers.next_deadline(), self.net.next_deadline())
+                     if d is not None]
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - self.clock())
+
+
+class MultiRaft(EventLoop):
+    """Hosts several independent Raft groups in one process. Each group owns a
+    range of key hashes and elects its own leader, preferring a different
+    node per group, so leadership (and write load) spreads across the
+    cluster. The groups share one Net, which batches everything bound for a
+    peer into one message per tick. A shared heartbeat timer has every group
+    we lead send its heartbeats in the same tick, so they go out together."""
+
+    def __init__(self, groups, clock=time.time, transport=None):
+        self.clock = clock
+        self.net = Net(transport, clock)
+        self.net.batch_peers = True
+        self.groups = [RaftNode(clock, net=GroupNet(self.net, g), group=g)
+                       for g in range(groups)]
+        for group in self.groups:
+            group.shared_heartbeats = True
+        self.next_heartbeat = 0     # When the groups we lead next heartbeat
+        self.node_id = None
+        self.setup_handlers()
+
+    def group_of(self, key):
+        """Which group owns a key: the one whose slice of the hash space its
+        hash falls in. We hash the standard library's ASCII-only encoding,
+        not our codec's: JSON libraries escape differently (ujson escapes
+        "/", say), and every node must route a key the same way."""
+        h = zlib.crc32(json.dumps(key, separators=(",", ":"), ensure_ascii=True)
+                       .encode("utf-8")) & 0xffffffff
+        return h * len(self.groups) >> 32
+
+    def setup_handlers(self):
+        """Registers handlers for messages that aren't for a particular group."""
+
+        def raft_init(msg):
+            body = msg["body"]
+            self.node_id = body["node_id"]
+            for group in self.groups:
+                group.init(body["node_id"], body["node_ids"], body.get("learners"))
+            log("I am:", self.node_id, "hosting", len(self.groups), "groups")
+            self.net.reply(msg, {"type": "raft_init_ok"})
+
+        self.net.on("raft_init", raft_init)
+
+        def kv_req(msg):
+            # Clients don't know about groups; send each request to its key's
+            problem = op_problem(msg["body"])
+            if problem:
+                self.net.reply(msg, {"type": "error", "code": 12, "text": problem})
+            else:
+                self.groups[self.group_of(msg["body"]["key"])].net.handle(msg)
+
+        self.net.on("read", kv_req)
+        self.net.on("write", kv_req)
+        self.net.on("cas", kv_req)
+
+        def txn(msg):
+            # A txn's keys must all belong to one group, which applies it
+            # atomically; we don't coordinate commits across groups.
+            body = msg["body"]
+            problem = op_problem(body)
+            groups = set() if problem else set(self.group_of(k) for _, k, _ in body["txn"])
+            if problem or 1 < len(groups):
+                self.net.reply(msg, {
+                    "type": "error",
+                    "code": 12 if problem else 10,
+                    "text": problem or "txn spans more than one group",
+                    })
+            else:
+                self.groups[groups.pop() if groups else 0].net.handle(msg)
+
+        self.net.on("txn", txn)
+
+        def stats(msg):
+            self.net.reply(msg, {"type": "stats_ok", "stats": {
+                "node": self.node_id,
+                "groups": [group.stats() for group in self.groups],
+                }})
+
+        self.net.on("stats", stats)
+
+        def profile(msg):
+            self.net.reply(msg, start_profile(msg["body"]))
+
+        self.net.on("profile", profile)
+
+        def transfer_leadership(msg):
+            # Hands off leadership of every group we lead, say before a restart.
+            # Requests tagged with a group go straight to that group instead.
+            to = msg["body"].get("to")
+            transfers = []
+            for group in self.groups:
+                target = group.transfer_leadership(to)
+                if target is not None:
+                    transfers.append([group.group, target])
+            self.net.reply(msg, {"type": "transfer_leadership_ok", "transfers": transfers})
+
+        self.net.on("transfer_leadership", transfer_leadership)
+
+        def membership(msg):
+            # Each group has its own configuration, and changes its own
+            self.net.reply(msg, {
+                "type": "error",
+                "code": 10,
+                "text": "membership changes must name a group",
+                })
 
-RaftNode().main()
+        self.net.on("add_learner", membership)
+        self.net.on("promote_learner", membership)
+        self.net.on("remove_node", membership)
+
+    def heartbeat(self):
+        """If it's time, asks every group we lead for a heartbeat round. They
+        all send this tick, so each peer gets one batch, not one message per
+        group. We go at the shortest of the leaders' heartbeat intervals."""
+        leaders = [group for group in self.groups if group.state == "leader"]
+        now = self.clock()
+        if leaders and self.next_heartbeat <= now:
+            for group in leaders:
+                group.heartbeat_requested = True
+            self.next_heartbeat = now + min(group.heartbeat_interval for group in leaders)
+
+    def tick(self):
+        """Ticks every group."""
+        self.heartbeat()
+        for group in self.groups:
+            group.tick()
+
+    def wait_time(self):
+        """How long can we block before any group has more to do?"""
+        waits = [w for w in (group.wait_time() for group in self.groups) if w is not None]
+        if any(group.state == "leader" for group in self.groups):
+            waits.append(max(0, self.next_heartbeat - self.clock()))
+        return min(waits) if waits else None
+
+
+if __name__ == "__main__":
+    groups = int(os.environ.get("RAFT_GROUPS", 1))
+    if 1 < groups:
+        MultiRaft(groups).main()
+    else:
+        RaftNode().main()
@@ -0,0 +1,681 @@
+#!/usr/bin/env python
+
+"""Runs a cluster of raft.py nodes inside one process, on a virtual clock,
+over a simulated network with configurable latency, loss, and partitions,
+under a Maelstrom-style lin-kv client workload. Runs are deterministic for a
+given seed, and take seconds rather than minutes, which makes this the place
+to benchmark changes before trying them against Maelstrom proper.
+
+    python sim.py --nodes 5 --time 60 --rate 200 --loss 0.01
+    python sim.py --partition 20:30:n1,n2 --seed 3
+    python sim.py --groups 6 --rate 2000 --clients 200
+    python sim.py --transfer-interval 5
+    python sim.py bench
+    python sim.py replay --trace n1.trace.gz --profile replay.txt
+    python sim.py tcp --nodes 5
+
+Replay runs a trace a node recorded with RAFT_RECORD=n1.trace.gz back
+through a single node, which makes for a repeatable hot-path benchmark.
+The tcp command checks a real cluster instead: raft.py processes over TCP,
+with requests sent through every node, followers included.
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import collections
+import gzip
+import heapq
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import raft
+
+
+class SimTransport:
+    """Carries a simulated node's messages through the Sim, in place of stdin
+    and stdout."""
+
+    def __init__(self, sim, node_id):
+        self.sim = sim
+        self.node_id = node_id
+        self.inbox = []         # Encoded messages delivered, but not yet read
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def read(self, timeout):
+        """Everything delivered since the last read; never blocks."""
+        lines = self.inbox
+        self.inbox = []
+        self.bytes_in += sum(len(line) + 1 for line in lines)
+        return [raft.codec.loads(line) for line in lines], True
+
+    def write(self, msgs):
+        """Hands each message to the simulated network. Encoding them means
+        the receiver gets its own copy, as it would over a real network."""
+        for msg in msgs:
+            line = raft.codec.dumps(msg)
+            self.bytes_out += len(line) + 1
+            self.sim.send(msg, line)
+
+    def close(self):
+        pass
+
+
+class ReplayTransport:
+    """Hands a node the messages from a recorded trace, and throws away what
+    it sends, after encoding it as a real transport would."""
+
+    def __init__(self):
+        self.inbox = []         # Encoded messages for the next read
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.msgs_out = 0
+
+    def read(self, timeout):
+        lines = self.inbox
+        self.inbox = []
+        self.bytes_in += sum(len(line) + 1 for line in lines)
+        return [raft.codec.loads(line) for line in lines], True
+
+    def write(self, msgs):
+        for msg in msgs:
+            self.bytes_out += len(raft.codec.dumps(msg)) + 1
+        self.msgs_out += len(msgs)
+
+    def close(self):
+        pass
+
+
+def open_trace(path):
+    return gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")
+
+
+def trace_seed(path):
+    """The seed the recording node reseeded random with, or None."""
+    with open_trace(path) as f:
+        line = f.readline()
+    return int(line.split()[1]) if line.startswith(b"#seed ") else None
+
+
+def read_trace(path):
+    """Yields (time, encoded messages) for each batch of messages in a trace
+    that RAFT_RECORD wrote."""
+    with open_trace(path) as f:
+        batch, batch_time = [], None
+        for line in f:
+            if line.startswith(b"#"):
+                continue
+            t, _, data = line.rstrip(b"\n").partition(b" ")
+            t = float(t)
+            if batch and t != batch_time:
+                yield batch_time, batch
+                batch = []
+            batch_time = t
+            batch.append(data)
+        if batch:
+            yield batch_time, batch
+
+
+def replay(path, groups=1, profile=None):
+    """Feeds a trace back into a fresh node as fast as it'll go, on a clock
+    that reads the recorded times, firing its timers in between batches, and
+    with random seeded as the recording node's was. The node only hears
+    from its peers what the trace says, so if it strays from the recorded
+    run (its timers can fire a little earlier or later than they did live)
+    replies to RPCs it didn't send again are dropped, and the rest of the
+    replay reproduces the recorded load rather than the exact run. Returns
+    results."""
+    seed = trace_seed(path)
+    random.seed(0 if seed is None else seed)
+    now = [0.0]
+    clock = lambda: now[0]
+    transport = ReplayTransport()
+    if 1 < groups:
+        node = raft.MultiRaft(groups, clock, transport)
+    else:
+        node = raft.RaftNode(clock, transport)
+    profiler = raft.Profiler(profile, float("inf")).start() if profile else None
+    started = time.time()
+    batches = 0
+    for t, lines in read_trace(path):
+        # Timers that came due before this batch arrived. We move the clock
+        # on at least a microsecond a step: now + (deadline - now) can round
+        # to just short of the deadline, which would stall a timer forever.
+        wait = node.wait_time()
+        while wait is not None and now[0] + wait < t:
+            now[0] += max(wait, 1e-6)
+            node.step(0)
+            wait = node.wait_time()
+        now[0] = max(now[0], t)
+        transport.inbox = lines
+        node.step(0)
+        batches += 1
+    wall = time.time() - started
+    if profiler:
+        profiler.stop()
+    return {
+        "msgs_in": node.net.msgs_in,
+        "msgs_out": transport.msgs_out,
+        "bytes_in": transport.bytes_in,
+        "bytes_out": transport.bytes_out,
+        "batches": batches,
+        "recorded": now[0],
+        "wall": wall,
+        }
+
+
+class Client:
+    """A client with at most one request outstanding, like Maelstrom's."""
+
+    def __init__(self, id, node):
+        self.id = id
+        self.node = node        # The node we send requests to
+        self.msg_id = 0         # Our latest request's ID
+        self.pending = None     # (sent time, body) of our outstanding request
+
+
+class Sim:
+    """A cluster of RaftNodes, the network between them, and their clients.
+    Time only moves when the next event (a delivery, a client request, or a
+    node's timer) comes due, so idle stretches cost nothing."""
+
+    def __init__(self, nodes=3, seed=0, latency=0.001, latency_dist="exponential",
+                 loss=0.0, partitions=(), clients=10, rate=100, keys=5,
+                 client_timeout=5, step_cost=0.00001, groups=1,
+                 transfer_interval=None, learners=0, retry_after=None):
+        self.now = 0.0
+        self.rng = random.Random(seed)  # For the network and the workload
+        random.seed(seed)               # For the nodes' election timeouts
+        self.latency = latency          # Mean one-way message latency, seconds
+        self.latency_dist = latency_dist  # constant, uniform, or exponential
+        self.loss = loss                # Chance a node-to-node message is lost
+        self.partitions = list(partitions)  # (start, end, isolated nodes)s
+        self.rate = rate                # Client requests per second, overall
+        self.keys = keys                # How many keys clients work on
+        self.client_timeout = client_timeout  # Give up on requests after this
+        self.retry_after = retry_after  # Resend unanswered requests this often
+        self.step_cost = step_cost      # Least time between a node's steps
+        self.transfer_interval = transfer_interval
+                                        # How often leaders hand off, if ever
+        self.events = []                # Heap of (time, seq, function, args)
+        self.seq = 0                    # Breaks ties between events in order
+
+        self.node_ids = ["n" + str(i + 1) for i in range(nodes + learners)]
+        self.learners = self.node_ids[nodes:]  # Extra nodes that don't vote
+        self.transports = {}
+        self.nodes = {}
+        self.wake = {}                  # When each node next needs a step
+        for id in self.node_ids:
+            self.transports[id] = SimTransport(self, id)
+            if 1 < groups:
+                self.nodes[id] = raft.MultiRaft(groups, self.clock, self.transports[id])
+            else:
+                self.nodes[id] = raft.RaftNode(self.clock, self.transports[id])
+            self.wake[id] = 0.0
+        self.clients = {}
+        for i in range(clients):
+            c = Client("c" + str(i + 1), self.node_ids[i % len(self.node_ids)])
+            self.clients[c.id] = c
+
+        # Statistics
+        self.messages = 0               # Node-to-node messages sent
+        self.lost = 0                   # ... and dropped by loss or partitions
+        self.requests = 0               # Client requests sent
+        self.latencies = []             # Of successful client requests
+        self.errors = collections.Counter()  # Error replies, by code
+        self.timeouts = 0               # Requests that never got a reply
+        self.retries = 0                # Requests sent again, with the same ID
+        self.candidacies = set()        # (node, group, term)s of every election
+        self.leaders = {}               # (group, term)s to the node that led it
+
+        for id in self.node_ids:
+            self.deliver(id, raft.codec.dumps({
+                "src": "c0", "dest": id, "body": {
+                    "type": "raft_init", "msg_id": 0,
+                    "node_id": id, "node_ids": self.node_ids,
+                    "learners": self.learners}}))
+        if rate:
+            self.at(self.rng.expovariate(rate), self.arrival)
+        if transfer_interval:
+            self.at(transfer_interval, self.transfer)
+
+    def clock(self):
+        """The nodes' clock."""
+        return self.now
+
+    def at(self, t, fn, *args):
+        """Schedules fn(*args) to run at time t."""
+        self.seq += 1
+        heapq.heappush(self.events, (t, self.seq, fn, args))
+
+    def delay(self):
+        """A one-way message latency."""
+        if self.latency_dist == "constant":
+            return self.latency
+        if self.latency_dist == "uniform":
+            return self.rng.uniform(0, 2 * self.latency)
+        return self.rng.expovariate(1.0 / self.latency) if self.latency else 0
+
+    def connected(self, a, b):
+        """Can a and b currently talk to each other?"""
+        for start, end, isolated in self.partitions:
+            if start <= self.now < end and (a in isolated) != (b in isolated):
+                return False
+        return True
+
+    def send(self, msg, line):
+        """Routes a message a node wrote out, and its encoding."""
+        src, dest = msg["src"], msg["dest"]
+        if dest in self.nodes:
+            if src in self.nodes:
+                self.messages += 1
+                if not self.connected(src, dest) or self.rng.random() < self.loss:
+                    self.lost += 1
+                    return
+            self.at(self.now + self.delay(), self.deliver, dest, line)
+        elif dest in self.clients:
+            self.at(self.now + self.delay(), self.receive, self.clients[dest], msg["body"])
+
+    def deliver(self, dest, line):
+        """A message arrives at a node, which takes a step to handle it."""
+        self.transports[dest].inbox.append(line)
+        self.wake[dest] = self.now
+
+    def transfer(self):
+        """Asks every leader to hand leadership off, as an operator would
+        before restarting it."""
+        self.at(self.now + self.transfer_interval, self.transfer)
+        for id in self.node_ids:
+            if any(r.state == "leader" for r in self.rafts(id)):
+                self.deliver(id, raft.codec.dumps({
+                    "src": "c0", "dest": id, "body": {
+                        "type": "transfer_leadership", "msg_id": 0}}))
+
+    # Workload
+
+    def arrival(self):
+        """It's time for a new request: hand it to a random idle client."""
+        self.at(self.now + self.rng.expovariate(self.rate), self.arrival)
+        idle = [c for c in self.clients.values() if c.pending is None]
+        if idle:
+            self.request(self.rng.choice(idle))
+
+    def request(self, client):
+        """Sends a random read, write, or cas, like Maelstrom's lin-kv."""
+        f = self.rng.choice(["read", "write", "cas"])
+        body = {"type": f, "key": self.rng.randrange(self.keys)}
+        if f == "write":
+            body["value"] = self.rng.randrange(5)
+        elif f == "cas":
+            body["from"] = self.rng.randrange(5)
+            body["to"] = self.rng.randrange(5)
+        client.msg_id += 1
+        body["msg_id"] = client.msg_id
+        client.pending = (self.now, body)
+        self.requests += 1
+        self.at(self.now + self.client_timeout, self.timed_out, client, client.msg_id)
+        self.send_request(client, client.node, body)
+
+    def send_request(self, client, node, body):
+        """Sends a client's request to node, arranging to retry it if asked."""
+        if self.retry_after:
+            self.at(self.now + self.retry_after, self.retry, client, body["msg_id"])
+        self.at(self.now + self.delay(), self.deliver, node, raft.codec.dumps(
+            {"src": client.id, "dest": node, "body": body}))
+
+    def retry(self, client, msg_id):
+        """A client that's still waiting sends its request again, unchanged,
+        to a random node, as a client with a short timeout might."""
+        if client.pending is not None and client.msg_id == msg_id:
+            self.retries += 1
+            self.send_request(client, self.rng.choice(self.node_ids), client.pending[1])
+
+    def receive(self, client, body):
+        """A reply reaches a client."""
+        if client.pending is None or body.get("in_reply_to") != client.msg_id:
+            return
+        sent, req = client.pending
+        client.pending = None
+        if body["type"] == "error" and body["code"] != 20 \
+                and not (body["code"] == 22 and req["type"] == "cas"):
+            # Missing keys and failed cases are proper answers, not errors
+            self.errors[body["code"]] += 1
+        else:
+            self.latencies.append(self.now - sent)
+
+    def timed_out(self, client, msg_id):
+        """A client gives up on a request nobody answered."""
+        if client.pending is not None and client.msg_id == msg_id:
+            client.pending = None
+            self.timeouts += 1
+
+    # Running
+
+    def step(self, id):
+        """Lets a node handle its messages and timers."""
+        node = self.nodes[id]
+        node.step(0)
+        for group, r in enumerate(self.rafts(id)):
+            if r.state == "candidate":
+                self.candidacies.add((id, group, r.current_term))
+            elif r.state == "leader":
+                self.leaders[(group, r.current_term)] = id
+        wait = node.wait_time()
+        self.wake[id] = float("inf") if wait is None \
+            else self.now + max(wait, self.step_cost)
+
+    def rafts(self, id):
+        """The RaftNodes a node runs: one per group."""
+        node = self.nodes[id]
+        return node.groups if isinstance(node, raft.MultiRaft) else [node]
+
+    def run(self, duration):
+        """Runs the cluster until the clock reaches duration."""
+        while True:
+            t = min(self.wake.values())
+            if self.events and self.events[0][0] < t:
+                t = self.events[0][0]
+            if duration < t:
+                break
+            self.now = max(self.now, t)
+            while self.events and self.events[0][0] <= self.now:
+                _, _, fn, args = heapq.heappop(self.events)
+                fn(*args)
+            for id in self.node_ids:
+                if self.wake[id] <= self.now:
+                    self.step(id)
+        self.now = duration
+
+    def results(self):
+        """What happened, as a dict."""
+        lat = sorted(self.latencies)
+        minutes = self.now / 60.0
+        return {
+            "requests": self.requests,
+            "ok": len(lat),
+            "throughput": len(lat) / self.now if self.now else 0,
+            "p50": lat[len(lat) // 2] if lat else None,
+            "p99": lat[min(len(lat) - 1, int(len(lat) * 0.99))] if lat else None,
+            "errors": dict(self.errors),
+            "timeouts": self.timeouts,
+            "retries": self.retries,
+            "elections": len(self.candidacies),
+            "elections_per_minute": len(self.candidacies) / minutes if minutes else 0,
+            "leaders": len(self.leaders),
+            "messages": self.messages,
+            "lost": self.lost,
+            "phases": self.phases(),
+            }
+
+    def phases(self):
+        """Per-phase latencies, as traced by every group's current leader,
+        except proxying, which followers time."""
+        merged = collections.defaultdict(raft.Histogram)
+        for id in self.node_ids:
+            for r in self.rafts(id):
+                for phase, h in r.latencies.items():
+                    if (phase == "proxy") != (r.state == "leader"):
+                        merged[phase].merge(h)
+        return dict((phase, h.summary()) for phase, h in merged.items())
+
+
+def random_partitions(node_ids, duration, interval, rng):
+    """Alternates healthy and partitioned stretches of interval seconds,
+    cutting off a random minority of nodes each time."""
+    partitions = []
+    t = interval
+    while t < duration:
+        n = rng.randint(1, (len(node_ids) - 1) // 2 or 1)
+        partitions.append((t, t + interval, set(rng.sample(node_ids, n))))
+        t += 2 * interval
+    return partitions
+
+
+def ms(t):
+    return "-" if t is None else "%.2fms" % (t * 1000)
+
+
+def simulate(duration=60, nemesis_interval=None, **kwargs):
+    """Runs a simulation, returning its results and how long it took."""
+    sim = Sim(**kwargs)
+    if nemesis_interval:
+        sim.partitions += random_partitions(sim.node_ids, duration,
+                                            nemesis_interval, sim.rng)
+    started = time.time()
+    sim.run(duration)
+    return sim.results(), time.time() - started
+
+
+# Scenarios for `sim.py bench`: name, then options on top of the defaults
+SCENARIOS = [
+    ("healthy", {}),
+    ("slow network", {"latency": 0.02}),
+    ("lossy", {"loss": 0.05}),
+    ("partitions", {"nemesis_interval": 10}),
+    ("transfers", {"transfer_interval": 5}),
+    ("five nodes", {"nodes": 5}),
+    ("heavy load", {"rate": 1000, "clients": 100}),
+    ("sharded", {"rate": 1000, "clients": 100, "groups": 6, "keys": 60}),
+    ]
+
+
+def bench(args):
+    """Runs every scenario, one line of results each."""
+    print("%-14s %9s %9s %9s %9s %8s %9s" % (
+        "scenario", "ops/s", "p50", "p99", "elect/min", "errors", "wall"))
+    for name, options in SCENARIOS:
+        kwargs = dict(vars(args))
+        kwargs.update(options)
+        r, wall = simulate(**kwargs)
+        print("%-14s %9.1f %9s %9s %9.2f %8d %8.2fs" % (
+            name, r["throughput"], ms(r["p50"]), ms(r["p99"]),
+            r["elections_per_minute"],
+            sum(r["errors"].values()) + r["timeouts"], wall))
+
+
+class TcpClient:
+    """A client of one node of a real cluster, speaking lines of JSON over its
+    client listener, one request at a time."""
+
+    def __init__(self, address, name=None):
+        self.sock = socket.create_connection(address)
+        self.buffer = b""       # What we've received past the last line
+        self.name = name        # The src we give, if any
+        self.next_msg_id = 0
+
+    def request(self, body, timeout=5):
+        """Sends a request, and returns the reply's body, or None if none
+        comes within timeout seconds."""
+        self.next_msg_id += 1
+        body = dict(body, msg_id=self.next_msg_id)
+        msg = {"body": body}
+        if self.name:
+            msg["src"] = self.name
+        self.sock.sendall(raft.codec.dumps(msg) + b"\n")
+        deadline = time.time() + timeout
+        while True:
+            if b"\n" in self.buffer:
+                line, self.buffer = self.buffer.split(b"\n", 1)
+                reply = raft.codec.loads(line)["body"]
+                if reply.get("in_reply_to") == body["msg_id"]:
+                    return reply
+                continue
+            if deadline <= time.time():
+                return None
+            self.sock.settimeout(deadline - time.time())
+            try:
+                data = self.sock.recv(1 << 16)
+            except socket.timeout:
+                return None
+            if not data:
+                return None
+            self.buffer += data
+
+    def close(self):
+        self.sock.close()
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def tcp_check(nodes=3):
+    """Runs a real cluster: a raft.py process per node, talking over TCP on
+    localhost. Writes through each node in turn, followers included, and
+    after each write reads through every node, expecting to see it; then a
+    cas through each. Returns a list of problems, empty if all went well."""
+    ids = ["n" + str(i + 1) for i in range(nodes)]
+    peers = ",".join("%s=127.0.0.1:%d" % (id, free_port()) for id in ids)
+    client_addresses = dict((id, ("127.0.0.1", free_port())) for id in ids)
+    procs = []
+    clients = {}
+    problems = []
+    try:
+        for id in ids:
+            env = dict(os.environ, RAFT_IO="tcp", RAFT_TCP_NODE=id, RAFT_TCP_PEERS=peers,
+                       RAFT_TCP_CLIENT="%s:%d" % client_addresses[id])
+            env.pop("RAFT_DATA_DIR", None)
+            env.setdefault("RAFT_LOG_LEVEL", "warn")
+            procs.append(subprocess.Popen([sys.executable, raft.__file__], env=env,
+                                          stdin=subprocess.DEVNULL))
+        deadline = time.time() + 10
+        for i, id in enumerate(ids):
+            while True:
+                try:
+                    # Every other node's client names itself, so both kinds
+                    # of client ID get exercised
+                    clients[id] = TcpClient(client_addresses[id], "c1" if i % 2 else None)
+                    break
+                except (IOError, OSError):
+                    if deadline < time.time():
+                        return ["couldn't connect to " + id]
+                    time.sleep(0.05)
+
+        def request(id, body):
+            # Retries while there's no leader, which is only at startup
+            while True:
+                res = clients[id].request(body)
+                if res is None or res["type"] != "error" or res["code"] != 11 \
+                        or deadline < time.time():
+                    return res
+                time.sleep(0.05)
+
+        for i, id in enumerate(ids):
+            res = request(id, {"type": "write", "key": "k", "value": i})
+            if res is None or res["type"] != "write_ok":
+                problems.append("write %d through %s got %s" % (i, id, res))
+            for reader in ids:
+                res = request(reader, {"type": "read", "key": "k"})
+                if res is None or res.get("value") != i:
+                    problems.append("read through %s after write %d got %s" % (reader, i, res))
+        value = len(ids) - 1
+        for id in ids:
+            res = request(id, {"type": "cas", "key": "k", "from": value, "to": value + 1})
+            if res is None or res["type"] != "cas_ok":
+                problems.append("cas %d to %d through %s got %s" % (value, value + 1, id, res))
+            value += 1
+        return problems
+    finally:
+        for client in clients.values():
+            client.close()
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+
+
+def parse_partition(spec):
+    """START:END, or START:END:n1,n2 to choose who's cut off."""
+    parts = spec.split(":")
+    if len(parts) not in (2, 3):
+        raise argparse.ArgumentTypeError("expected START:END[:NODES], not " + spec)
+    isolated = set(parts[2].split(",")) if len(parts) == 3 else {"n1"}
+    return (float(parts[0]), float(parts[1]), isolated)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates a raft.py cluster.")
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "bench", "replay", "tcp"])
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--learners", type=int, default=0,
+                        help="extra nodes that replicate the log, but don't vote")
+    parser.add_argument("--groups", type=int, default=1,
+                        help="Raft groups per node, sharding the keys")
+    parser.add_argument("--time", dest="duration", type=float, default=60,
+                        help="simulated seconds to run for")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rate", type=float, default=100,
+                        help="client requests per second")
+    parser.add_argument("--clients", type=int, default=10)
+    parser.add_argument("--keys", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.001,
+                        help="mean one-way message latency, in seconds")
+    parser.add_argument("--latency-dist", default="exponential",
+                        choices=["constant", "uniform", "exponential"])
+    parser.add_argument("--retry-after", type=float,
+                        help="clients resend unanswered requests this often")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="chance of losing each node-to-node message")
+    parser.add_argument("--partition", dest="partitions", type=parse_partition,
+                        action="append", default=[],
+                        help="cut nodes off from the rest: START:END[:n1,n2]")
+    parser.add_argument("--nemesis-interval", type=float,
+                        help="partition a random minority every other interval")
+    parser.add_argument("--transfer-interval", type=float,
+                        help="ask leaders to hand off leadership this often")
+    parser.add_argument("--trace", help="for replay: a trace RAFT_RECORD wrote")
+    parser.add_argument("--profile",
+                        help="for replay: write collapsed stacks of the replay here")
+    parser.add_argument("--log-level", default="warn", choices=sorted(raft.LEVELS))
+    args = parser.parse_args()
+    raft.logger.level = raft.LEVELS[args.log_level]
+    command = args.command
+    trace, profile = args.trace, args.profile
+    del args.command, args.log_level, args.trace, args.profile
+
+    if command == "replay":
+        if not trace:
+            parser.error("replay needs --trace")
+        r = replay(trace, args.groups, profile)
+        print("Replayed %d messages (%gs recorded) in %.2fs: %.0f msgs/s" % (
+            r["msgs_in"], r["recorded"], r["wall"], r["msgs_in"] / max(r["wall"], 1e-9)))
+        print("sent      %d messages, %d bytes in, %d bytes out" % (
+            r["msgs_out"], r["bytes_in"], r["bytes_out"]))
+        return
+
+    if command == "bench":
+        return bench(args)
+
+    if command == "tcp":
+        problems = tcp_check(args.nodes)
+        for problem in problems:
+            print(problem)
+        print("%d problems" % len(problems))
+        sys.exit(1 if problems else 0)
+
+    r, wall = simulate(**vars(args))
+    print("Simulated %d nodes%s for %gs in %.2fs" % (
+        args.nodes, " and %d learners" % args.learners if args.learners else "",
+        args.duration, wall))
+    print("requests  %d, %d ok (%.1f/s), errors %s, timeouts %d, retries %d" % (
+        r["requests"], r["ok"], r["throughput"], r["errors"], r["timeouts"], r["retries"]))
+    print("latency   p50 %s, p99 %s" % (ms(r["p50"]), ms(r["p99"])))
+    print("elections %d (%.2f/min), %d leaders" % (
+        r["elections"], r["elections_per_minute"], r["leaders"]))
+    print("messages  %d between nodes, %d lost" % (r["messages"], r["lost"]))
+    for phase in ("proxy", "append", "commit", "apply", "reply", "read_index"):
+        if phase in r["phases"]:
+            h = r["phases"][phase]
+            print("  %-10s %7d ops, p50 %s, p99 %s" % (
+                phase, h["count"], ms(h["p50"]), ms(h["p99"])))
+
+
+if __name__ == "__main__":
+    main()